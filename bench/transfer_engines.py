@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Compare rsync and tar transfer engines on payloads of many small files.
+
+Uploads generated payloads to HOST:DIR with each engine and prints time
+of every run, for example:
+
+    bench/transfer_engines.py -t ws1-400 -d /tmp/cljob-bench
+
+--engines picks engines to compare, for example tar,tar+gzip where there is
+no rsync.
+"""
+
+import os
+import sys
+import shutil
+from tempfile import mkdtemp
+from time import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cljob import rsh
+from cljob.job import UploadJob
+
+def make_payload(files_num, file_size):
+    payload = mkdtemp(prefix='cljob-bench.')
+    data = 'x' * file_size
+    for i in xrange(files_num):
+        subdir = os.path.join(payload, '%03d' % (i % 100))
+        if not os.path.isdir(subdir):
+            os.makedirs(subdir)
+        bench_file = open(os.path.join(subdir, '%06d' % i), 'w')
+        bench_file.write(data)
+        bench_file.close()
+    return payload + os.path.sep
+
+def upload(host, files, target, **args):
+    start_time = time()
+    for job in rsh.run_upload_jobs([ UploadJob(host, files, target) ], timeout = 0, **args):
+        if job.exception != None or job.retcode != 0:
+            raise Exception("Upload failed.", job.retcode, job.stderr, job.exception)
+    return time() - start_time
+
+def main():
+    optparser = OptionParser()
+    optparser.add_option('-t', '--host', dest='host', default='localhost', \
+                         help='target host, default is localhost')
+    optparser.add_option('-d', '--dir', dest='dir', default='/tmp/cljob-bench', \
+                         help='target dir on host, default is /tmp/cljob-bench')
+    optparser.add_option('-n', '--files', dest='files', default='100,1000,10000,30000', \
+                         help='comma separated files numbers, default is 100,1000,10000,30000')
+    optparser.add_option('-s', '--sizes', dest='sizes', default='100,4096', \
+                         help='comma separated file sizes, default is 100,4096')
+    optparser.add_option('-e', '--engines', dest='engines', default='rsync,tar,tar+gzip', \
+                         help='comma separated engines, default is rsync,tar,tar+gzip')
+    options, args = optparser.parse_args()
+
+    all_engines = {
+        'rsync': {'engine': 'rsync'},
+        'tar': {'engine': 'tar', 'tar_compress': 'none'},
+        'tar+gzip': {'engine': 'tar', 'tar_compress': 'gzip'},
+    }
+    engines = []
+    for name in options.engines.split(','):
+        if name not in all_engines:
+            optparser.error("Unknown engine '%s'." % name)
+        engines.append((name, all_engines[name]))
+    print ('%8s %8s' + ' %10s' * len(engines)) % (('files', 'size') + tuple([ name for name, _ in engines ]))
+    for files_num in [ int(x) for x in options.files.split(',') ]:
+        for file_size in [ int(x) for x in options.sizes.split(',') ]:
+            payload = make_payload(files_num, file_size)
+            times = []
+            for name, args in engines:
+                target = os.path.join(options.dir, name)
+                times.append(upload(options.host, [payload], target, **args))
+            shutil.rmtree(payload)
+            print ('%8s %8s' + ' %9.2fs' * len(engines)) % ((files_num, file_size) + tuple(times))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,307 @@
+"""
+Long-lived agents on remote hosts for running many cmds over one rsh session.
+
+Agent is a small python program, started once for each host with rsh. It
+reads framed requests from stdin, runs each cmd in a separate process and
+writes framed result (exit code, stdout, stderr, timings) to stdout. Frame is
+4 bytes big-endian length and json dict.
+
+Request: {"id": N, "cmd": CMD, "head": BYTES, "tail": BYTES, "hash": ALGO}
+         or {"id": N, "cancel": true}
+Result: {"id": N, "retcode": CODE, "stdout": STREAM, "stderr": STREAM,
+         "start": TIME, "end": TIME}
+STREAM: {"head": BASE64, "tail": BASE64, "size": BYTES, "hash": HEX}
+
+Like capture.Capture, agent keeps only first head and last tail bytes of each
+stream (whole stream if both are zero) and hashes the whole stream with hash
+algorithm, if it is set. Result for cancelled request is sent anyway.
+"""
+
+import os
+import json
+import errno
+import fcntl
+import struct
+import atexit
+import base64
+import zlib
+from subprocess import Popen, PIPE
+
+AGENT_SOURCE = r'''
+import os, sys, json, struct, signal, threading, subprocess, time, base64, hashlib
+
+stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+lock = threading.Lock()
+procs = {}
+
+def read_exactly(size):
+    data = b''
+    while len(data) < size:
+        chunk = stdin.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def send(msg):
+    data = json.dumps(msg).encode('ascii')
+    lock.acquire()
+    try:
+        stdout.write(struct.pack('>I', len(data)) + data)
+        stdout.flush()
+    finally:
+        lock.release()
+
+def b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+def capture(stream, request, result, name):
+    head_size, tail_size = request.get('head', 0), request.get('tail', 0)
+    bounded = head_size > 0 or tail_size > 0
+    digest = None
+    if request.get('hash'):
+        digest = hashlib.new(request['hash'])
+    head, tail, size = [], b'', 0
+    while True:
+        chunk = os.read(stream.fileno(), 65536)
+        if not chunk:
+            break
+        size += len(chunk)
+        if digest is not None:
+            digest.update(chunk)
+        if not bounded:
+            head.append(chunk)
+            continue
+        head_len = sum([ len(data) for data in head ])
+        if head_len < head_size:
+            head.append(chunk[:head_size - head_len])
+            chunk = chunk[head_size - head_len:]
+        if tail_size > 0 and chunk:
+            tail = (tail + chunk)[-tail_size:]
+    stream.close()
+    result[name] = {'head': b64(b''.join(head)), 'tail': b64(tail), 'size': size,
+                    'hash': digest and digest.hexdigest()}
+
+def run(request):
+    start = time.time()
+    result = {'id': request['id']}
+    try:
+        proc = subprocess.Popen(['bash', '-c', request['cmd']], stdin=open(os.devnull),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                close_fds=True, preexec_fn=os.setsid)
+        procs[request['id']] = proc
+        reader = threading.Thread(target=capture, args=(proc.stderr, request, result, 'stderr'))
+        reader.start()
+        capture(proc.stdout, request, result, 'stdout')
+        reader.join()
+        result['retcode'] = proc.wait()
+    except Exception:
+        error = str(sys.exc_info()[1]).encode('utf-8')
+        result['retcode'] = 255
+        result['stdout'] = {'head': '', 'tail': '', 'size': 0, 'hash': None}
+        result['stderr'] = {'head': b64(error), 'tail': '', 'size': len(error), 'hash': None}
+    procs.pop(request['id'], None)
+    result['start'], result['end'] = start, time.time()
+    send(result)
+
+while True:
+    header = read_exactly(4)
+    if header is None:
+        break
+    request = json.loads(read_exactly(struct.unpack('>I', header)[0]).decode('utf-8'))
+    if request.get('cancel'):
+        proc = procs.get(request['id'])
+        if proc is not None:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        continue
+    thread = threading.Thread(target=run, args=(request,))
+    thread.daemon = True
+    thread.start()
+'''
+
+def agent_cmd(python = 'python'):
+    """
+    Return remote shell cmd to start agent.
+    """
+    source = base64.b64encode(zlib.compress(AGENT_SOURCE))
+    return '%s -c "import base64,zlib;exec(zlib.decompress(base64.b64decode(\'%s\')))"' % \
+           (python, source)
+
+class Agent(object):
+    """
+    Agent process on one host.
+    """
+    def __init__(self, host, python = 'python'):
+        self.host = host
+        self.proc = Popen(['rsh', host, agent_cmd(python)], \
+                          stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds = True)
+        fd = self.proc.stdout.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.buffer = ''
+        self.results = {}
+        # cancelled requests, which results are not got yet
+        self.cancelled = set()
+        self.next_id = 0
+        self.is_alive = True
+        self.exit_info = None
+
+    def send(self, request):
+        data = json.dumps(request)
+        self.proc.stdin.write(struct.pack('>I', len(data)) + data)
+        self.proc.stdin.flush()
+
+    def submit(self, cmd, head_size = 0, tail_size = 0, hash_name = None):
+        """
+        Send cmd to agent and return its request id.
+
+        head_size, tail_size, hash_name -- output capture limits and hash,
+                                           see capture.Capture
+        """
+        self.next_id += 1
+        self.send({'id': self.next_id, 'cmd': cmd, 'head': head_size, 'tail': tail_size, \
+                   'hash': hash_name})
+        return self.next_id
+
+    def cancel(self, request_id):
+        """
+        Kill cmd of request. Its result is dropped.
+        """
+        if self.results.pop(request_id, None) != None:
+            return
+        if self.is_alive:
+            self.cancelled.add(request_id)
+            try:
+                self.send({'id': request_id, 'cancel': True})
+            except IOError:
+                pass
+
+    def read(self):
+        """
+        Read available results without blocking.
+        """
+        while self.is_alive:
+            try:
+                data = os.read(self.proc.stdout.fileno(), 65536)
+            except OSError as ex:
+                if ex.errno in [errno.EAGAIN, errno.EINTR]:
+                    break
+                raise
+            if data == '':
+                self.is_alive = False
+                break
+            self.buffer += data
+
+        while len(self.buffer) >= 4:
+            size = struct.unpack('>I', self.buffer[:4])[0]
+            if len(self.buffer) < size + 4:
+                break
+            result = json.loads(self.buffer[4:size+4])
+            self.buffer = self.buffer[size+4:]
+            if result['id'] in self.cancelled:
+                self.cancelled.remove(result['id'])
+                continue
+            self.results[result['id']] = result
+
+    def pop_result(self, request_id):
+        """
+        Return result for request or None if it isn't ready.
+        """
+        self.read()
+        return self.results.pop(request_id, None)
+
+    def errors(self):
+        """
+        Return agent exit code and stderr after agent is dead.
+        """
+        if self.exit_info == None:
+            self.proc.stdin.close()
+            self.proc.stdin = None
+            _, stderr = self.proc.communicate()
+            self.exit_info = (self.proc.returncode, stderr)
+        return self.exit_info
+
+    def close(self):
+        if self.proc.poll() == None:
+            try:
+                if self.proc.stdin != None:
+                    self.proc.stdin.close()
+                self.proc.terminate()
+            except (IOError, OSError):
+                pass
+            self.proc.wait()
+
+class AgentCall(object):
+    """
+    Cmd running in agent. Replaces Popen object of a job in rsh runner.
+    """
+    def __init__(self, agent, cmd, head_size = 0, tail_size = 0, hash_name = None):
+        """
+        head_size, tail_size, hash_name -- output capture limits and hash,
+                                           applied by agent
+        """
+        self.agent = agent
+        self.pid = agent.proc.pid
+        self.request_id = agent.submit(cmd, head_size, tail_size, hash_name)
+        self.result = None
+
+    def poll(self):
+        if self.result == None:
+            self.result = self.agent.pop_result(self.request_id)
+        if self.result == None and not self.agent.is_alive:
+            retcode, stderr = self.agent.errors()
+            error = 'Agent on %s exited with code %s: %s' % (self.agent.host, retcode, stderr.strip())
+            self.result = {
+                'retcode': 255,
+                'stdout': {'head': '', 'tail': '', 'size': 0, 'hash': None},
+                'stderr': {'head': base64.b64encode(error), 'tail': '', 'size': len(error), \
+                           'hash': None},
+            }
+        if self.result == None:
+            return None
+        return self.result['retcode']
+
+    def write_output(self, stdout_capture, stderr_capture):
+        """
+        Write stdout and stderr of done cmd to captures with the same limits.
+        """
+        for name, capture in [('stdout', stdout_capture), ('stderr', stderr_capture)]:
+            stream = self.result[name]
+            head = base64.b64decode(stream['head'])
+            tail = base64.b64decode(stream['tail'])
+            capture.write(head)
+            capture.skip(stream['size'] - len(head) - len(tail), stream['hash'])
+            capture.write(tail)
+
+    def times(self):
+        """
+        Return start and end time of done cmd, reported by agent, or None.
+        """
+        if 'start' not in self.result:
+            return None
+        return self.result['start'], self.result['end']
+
+    def cancel(self):
+        if self.result == None:
+            self.agent.cancel(self.request_id)
+
+_agents = {}
+
+def get_agent(host, python = 'python'):
+    """
+    Return running agent for host, starting a new one if needed. Agents are
+    kept for the whole process lifetime.
+    """
+    key = (host, python)
+    if key not in _agents or not _agents[key].is_alive:
+        _agents[key] = Agent(host, python)
+    return _agents[key]
+
+@atexit.register
+def close_agents():
+    for agent in _agents.values():
+        agent.close()
+    _agents.clear()
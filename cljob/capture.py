@@ -0,0 +1,262 @@
+"""
+Bounded capture of job output streams.
+"""
+
+import os
+import re
+import errno
+import fcntl
+import select
+import hashlib
+from collections import deque
+from time import time, sleep
+
+class Capture(object):
+    """
+    Keep first head_size and last tail_size bytes of a stream, counting
+    dropped bytes in the middle and optionally hashing the whole stream.
+
+    >>> capture = Capture(4, 6)
+    >>> for chunk in ['0123', '456789', 'abcdef', 'ghij']:
+    ...     capture.write(chunk)
+    >>> capture.dropped
+    10
+    >>> capture.getvalue()
+    '0123\\n...[10 bytes dropped]...\\nefghij'
+    >>> capture = Capture()
+    >>> capture.write('abc')
+    >>> capture.getvalue(), capture.dropped
+    ('abc', 0)
+    """
+    def __init__(self, head_size = 0, tail_size = 0, hash_name = None):
+        """
+        head_size, tail_size -- bytes to keep from the stream start and end.
+                                If both are zero, keep the whole stream
+        hash_name -- hashlib algorithm to hash the whole stream, like 'md5'
+        """
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.bounded = head_size > 0 or tail_size > 0
+        self.hash = None
+        if hash_name != None:
+            self.hash = hashlib.new(hash_name)
+        # hash of the whole stream got from elsewhere, see skip()
+        self.digest = None
+
+        self.head = []
+        self.head_len = 0
+        self.tail = deque()
+        self.tail_len = 0
+        self.size = 0
+        # size of chunks removed from tail
+        self.dropped_chunks = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.hash != None:
+            self.hash.update(data)
+
+        if not self.bounded:
+            self.head.append(data)
+            return
+
+        if self.head_len < self.head_size:
+            chunk = data[:self.head_size - self.head_len]
+            self.head.append(chunk)
+            self.head_len += len(chunk)
+            data = data[len(chunk):]
+
+        if len(data) == 0:
+            return
+
+        self.tail.append(data)
+        self.tail_len += len(data)
+        # drop whole chunks out of the tail, keeping at least tail_size bytes
+        while len(self.tail) > 0 and self.tail_len - len(self.tail[0]) >= self.tail_size:
+            self.tail_len -= len(self.tail[0])
+            self.dropped_chunks += len(self.tail.popleft())
+
+    def skip(self, size, digest = None):
+        """
+        Count size bytes of the stream, dropped before they got here (for
+        example, by remote agent), as dropped from the middle.
+
+        digest -- hex hash of the whole stream, it replaces own hash
+
+        >>> capture = Capture(2, 2, 'md5')
+        >>> capture.write('ab')
+        >>> capture.skip(3, 'f00')
+        >>> capture.write('yz')
+        >>> capture.getvalue(), capture.size, capture.hexdigest()
+        ('ab\\n...[3 bytes dropped]...\\nyz', 7, 'f00')
+        """
+        if size == 0 and digest == None:
+            return
+        self.size += size
+        self.dropped_chunks += size
+        self.digest = digest
+
+    @property
+    def dropped(self):
+        """
+        Number of bytes dropped from the middle of the stream.
+        """
+        if not self.bounded:
+            return 0
+        return self.dropped_chunks + max(0, self.tail_len - self.tail_size)
+
+    def getvalue(self):
+        """
+        Return captured stream, with dropped bytes replaced by a marker line.
+        """
+        head = ''.join(self.head)
+        tail = ''.join(self.tail)
+        if self.dropped == 0:
+            return head + tail
+        tail = tail[len(tail) - self.tail_size:]
+        return '%s\n...[%s bytes dropped]...\n%s' % (head, self.dropped, tail)
+
+    def hexdigest(self):
+        """
+        Return hash of the whole stream or None if hashing is off.
+        """
+        if self.digest != None or self.hash == None:
+            return self.digest
+        return self.hash.hexdigest()
+
+class ExitCodeTrailer(object):
+    """
+    Split exit code trailer '\\nCODE\\n', printed after remote cmd output
+    (see TRAILER_CMD), from the stream written to capture. Last bytes of the
+    stream are held back, so the trailer is never captured, hashed or
+    counted and capture gets exactly the cmd output.
+
+    Output of the same cmd gets the same hash and size as without trailer
+    (from remote agent, which sends exit code separately):
+
+    >>> capture = Capture(hash_name = 'md5')
+    >>> trailer = ExitCodeTrailer(capture)
+    >>> for chunk in ['no newline at end', '\\n', '2\\n']:
+    ...     trailer.write(chunk)
+    >>> trailer.flush()
+    >>> trailer.retcode, capture.getvalue()
+    (2, 'no newline at end')
+    >>> agent_capture = Capture(hash_name = 'md5')
+    >>> agent_capture.write('no newline at end')
+    >>> (capture.size, capture.hexdigest()) == (agent_capture.size, agent_capture.hexdigest())
+    True
+
+    Stream without trailer (rsh error or killed cmd) is captured as is:
+
+    >>> capture = Capture()
+    >>> trailer = ExitCodeTrailer(capture)
+    >>> trailer.write('partial\\n12')
+    >>> trailer.flush()
+    >>> trailer.retcode, capture.getvalue()
+    (None, 'partial\\n12')
+    """
+    # '\n' + exit code up to 255 + '\n'
+    MAX_SIZE = 5
+
+    def __init__(self, capture):
+        self.capture = capture
+        self.held = ''
+        # cmd exit code or None if there is no trailer, set by flush()
+        self.retcode = None
+
+    def write(self, data):
+        data = self.held + data
+        if len(data) > self.MAX_SIZE:
+            self.capture.write(data[:-self.MAX_SIZE])
+            data = data[-self.MAX_SIZE:]
+        self.held = data
+
+    def flush(self):
+        """
+        Split trailer at the end of stream and write the rest to capture.
+        """
+        match = TRAILER_RE.search(self.held)
+        if match != None:
+            self.retcode = int(match.group(1))
+            self.held = self.held[:match.start()]
+        self.capture.write(self.held)
+        self.held = ''
+
+# shell cmd printing trailer with exit code of the previous cmd
+TRAILER_CMD = "printf '\\n%s\\n' $?"
+TRAILER_RE = re.compile('\\n(\\d{1,3})\\n\\Z')
+
+class CaptureReader(object):
+    """
+    Read streams of running processes into their captures without blocking.
+    """
+    def __init__(self):
+        self.poller = select.poll()
+        # fd -> (stream, capture)
+        self.streams = {}
+
+    def add(self, stream, capture):
+        fd = stream.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.streams[fd] = (stream, capture)
+        self.poller.register(fd, select.POLLIN | select.POLLPRI)
+
+    def _read(self, fd):
+        """
+        Read available data from fd. Return False if there is no data now.
+        """
+        stream, capture = self.streams[fd]
+        try:
+            data = os.read(fd, 65536)
+        except OSError as ex:
+            if ex.errno in [errno.EAGAIN, errno.EINTR]:
+                return False
+            raise
+        if data == '':
+            self.poller.unregister(fd)
+            del self.streams[fd]
+            stream.close()
+        else:
+            capture.write(data)
+        return True
+
+    def wait(self, timeout):
+        """
+        Read streams for timeout seconds.
+        """
+        deadline = time() + timeout
+        while True:
+            left = deadline - time()
+            if left <= 0:
+                return
+            if len(self.streams) == 0:
+                sleep(left)
+                return
+            try:
+                events = self.poller.poll(left * 1000)
+            except select.error as ex:
+                if ex[0] != errno.EINTR:
+                    raise
+                continue
+            for fd, _ in events:
+                if fd in self.streams:
+                    self._read(fd)
+
+    def finish(self, stream, block = True):
+        """
+        Read stream till the end and close it.
+
+        block -- wait for the end of stream. Otherwise read only available data
+        """
+        if stream.closed:
+            return
+        fd = stream.fileno()
+        if fd not in self.streams:
+            return
+        if block:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+        while fd in self.streams:
+            if not self._read(fd) and not block:
+                self.poller.unregister(fd)
+                del self.streams[fd]
+                stream.close()
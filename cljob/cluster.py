@@ -0,0 +1,277 @@
+"""
+Coordinated runs of shell jobs on several worker nodes.
+
+Coordinator splits jobs between workers. Worker is tcljob_worker process,
+started with rsh on worker node (or locally, for 'local' worker). It reads
+options and jobs as json lines from stdin, runs jobs by rsh.run_shell_jobs
+and writes json lines to stdout:
+    {"started": INDEX} -- job is started
+    {"done": INDEX, ...} -- job is done, other fields are from job_to_dict()
+Coordinator yields jobs as they are done, so normal handlers and progress
+display work as with local runs.
+"""
+
+import os
+import sys
+import json
+import errno
+import fcntl
+import select
+from threading import Thread
+from subprocess import Popen, PIPE
+
+import rsh
+from job import ShellJob, job_to_dict, dict_output
+from capture import Capture
+from probe import Liveness, default_liveness_path
+
+# rsh.run_shell_jobs args passed to workers, liveness is passed as probe options
+WORKER_ARGS = ['timeout', 'check_interval', 'max_simultanious_jobs', 'kill_grace', \
+               'capture_head', 'capture_tail', 'capture_hash', 'compress_output', \
+               'use_agent', 'remote_python', 'liveness']
+
+class WorkerError(Exception):
+    pass
+
+class RemoteError(Exception):
+    """
+    Exception of job on worker node, message is its description.
+    """
+    pass
+
+class RemoteCapture(object):
+    """
+    Results of job output capture on worker: stream size, bytes dropped by
+    capture limits and hash, like capture.Capture has.
+    """
+    def __init__(self, size, dropped = 0, digest = None):
+        self.size = size
+        self.dropped = dropped
+        self.digest = digest
+
+    def hexdigest(self):
+        return self.digest
+
+def partition(jobs, workers_num):
+    """
+    Split jobs list between workers round robin, keeping jobs order.
+
+    >>> partition(range(7), 3)
+    [[0, 3, 6], [1, 4], [2, 5]]
+    """
+    return [ jobs[i::workers_num] for i in xrange(workers_num) ]
+
+def local_worker_cmd():
+    """
+    Cmd to start worker locally with the same python and cljob package.
+    """
+    return [ sys.executable, '-c', 'from cljob import cluster; cluster.worker_main()' ]
+
+class Worker(object):
+    def __init__(self, node, jobs, args, worker_cmd = 'tcljob_worker'):
+        """
+        node -- host to start worker on with rsh or 'local'
+        jobs -- list of ShellJob for this worker
+        args -- rsh.run_shell_jobs() args
+        """
+        self.node = node
+        self.jobs = jobs
+        self.done = set()
+        self.buffer = ''
+        self.errors = Capture(0, 4096)
+
+        if node == 'local':
+            env = dict(os.environ)
+            package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            env['PYTHONPATH'] = os.pathsep.join([package_dir] + \
+                                                [ path for path in [env.get('PYTHONPATH')] if path ])
+            cmd = local_worker_cmd()
+        else:
+            env = None
+            cmd = [ 'rsh', node, worker_cmd ]
+        self.proc = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds = True, env = env)
+        for stream in [self.proc.stdout, self.proc.stderr]:
+            fd = stream.fileno()
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        lines = [ json.dumps(args) ]
+        lines += [ json.dumps({'host': job.host, 'wdir': job.wdir, 'cmd': job.cmd}) for job in jobs ]
+        # worker reads all jobs before it starts them, but write in a thread
+        # anyway to not depend on pipe buffers
+        writer = Thread(target=self._write, args=(''.join([ '%s\n' % line for line in lines ]),))
+        writer.daemon = True
+        writer.start()
+
+    def _write(self, data):
+        try:
+            self.proc.stdin.write(data)
+            self.proc.stdin.close()
+        except IOError:
+            # worker is dead, it is reported by read()
+            pass
+
+    def _read_fd(self, fd):
+        try:
+            return os.read(fd, 65536)
+        except OSError as ex:
+            if ex.errno not in [errno.EAGAIN, errno.EINTR]:
+                raise
+            return None
+
+    def read(self, fd):
+        """
+        Read worker stdout or stderr. Return list of events from stdout and
+        False if stream is closed.
+        """
+        data = self._read_fd(fd)
+        if data == None:
+            return [], True
+        if fd == self.proc.stderr.fileno():
+            self.errors.write(data)
+            return [], data != ''
+        if data == '':
+            return [], False
+        self.buffer += data
+        lines = self.buffer.split('\n')
+        self.buffer = lines.pop()
+        return [ json.loads(line) for line in lines ], True
+
+    def job_done(self, info):
+        """
+        Copy job result from worker record to job and return it.
+        """
+        job = self.jobs[info['done']]
+        self.done.add(info['done'])
+        job.retcode = info['retcode']
+        job.timeouted = info['timeouted']
+        job.cancelled = info['cancelled']
+        job.start_time = info['start_time']
+        job.end_time = info['end_time']
+        for stream in ['stdout', 'stderr']:
+            if info.get(stream) != None:
+                setattr(job, stream, dict_output(info, stream))
+            if info.get('%s_size' % stream) != None:
+                setattr(job, '%s_capture' % stream, \
+                        RemoteCapture(info['%s_size' % stream], info.get('%s_dropped' % stream, 0), \
+                                      info.get('%s_hash' % stream)))
+        if info['exception'] != None:
+            job.exception = RemoteError(info['exception'])
+        return job
+
+    def lost_jobs(self):
+        """
+        Fail jobs, which are not done by dead worker, and return them.
+        """
+        self.proc.wait()
+        error = WorkerError("Worker on %s exited with code %s: %s" % \
+                            (self.node, self.proc.returncode, self.errors.getvalue().strip()))
+        jobs = []
+        for i, job in enumerate(self.jobs):
+            if i not in self.done:
+                job.exception = error
+                jobs.append(job)
+        return jobs
+
+def run_cluster_jobs(jobs, workers, worker_cmd = 'tcljob_worker', monitor = None, \
+                     history = None, **args):
+    """
+    Run shell jobs on worker nodes and return iterator over them as they
+    are done.
+
+    jobs -- list of ShellJob
+    workers -- list of worker nodes, 'local' means local worker process
+    worker_cmd -- cmd to start worker on remote nodes
+    monitor -- object with job_started(job) method, see rsh._run_rsh_jobs()
+    history -- History of jobs durations: jobs are scheduled by it before
+               they are split between workers
+    args -- rsh.run_shell_jobs() args, see WORKER_ARGS. Workers probe hosts
+            with the same liveness options. Other args, which are not None,
+            raise ValueError: workers don't support them
+    """
+    unsupported = sorted([ name for name, value in args.iteritems() \
+                           if name not in WORKER_ARGS and value != None ])
+    if len(unsupported) > 0:
+        raise ValueError("%s can't be used with workers." % ', '.join(unsupported))
+    worker_args = dict([ (name, args[name]) for name in WORKER_ARGS \
+                         if name in args and name != 'liveness' ])
+    liveness = args.get('liveness')
+    if liveness != None:
+        worker_args['probe'] = {'ttl': liveness.ttl, 'port': liveness.port, 'timeout': liveness.timeout}
+    return _run_cluster_jobs(jobs, workers, worker_cmd, monitor, history, worker_args)
+
+def _run_cluster_jobs(jobs, workers, worker_cmd, monitor, history, worker_args):
+    if history != None:
+        history.schedule(jobs)
+    fds = {}
+    for node, node_jobs in zip(workers, partition(jobs, len(workers))):
+        if len(node_jobs) == 0:
+            continue
+        worker = Worker(node, node_jobs, worker_args, worker_cmd)
+        fds[worker.proc.stdout.fileno()] = worker
+        fds[worker.proc.stderr.fileno()] = worker
+
+    try:
+        while len(fds) > 0:
+            try:
+                readable, _, _ = select.select(fds.keys(), [], [])
+            except select.error as ex:
+                if ex[0] != errno.EINTR:
+                    raise
+                continue
+            for fd in readable:
+                worker = fds[fd]
+                events, is_open = worker.read(fd)
+                for info in events:
+                    if 'started' in info:
+                        if monitor != None:
+                            monitor.job_started(worker.jobs[info['started']])
+                        continue
+                    job = worker.job_done(info)
+                    if history != None:
+                        history.record(job)
+                    yield job
+                if is_open:
+                    continue
+                del fds[fd]
+                if worker.proc.stdout.fileno() not in fds and \
+                   worker.proc.stderr.fileno() not in fds:
+                    for job in worker.lost_jobs():
+                        yield job
+    finally:
+        if history != None:
+            history.save()
+
+class _StartedWriter(object):
+    def __init__(self, outfile, indexes):
+        self.outfile = outfile
+        self.indexes = indexes
+
+    def job_started(self, job):
+        self.outfile.write('%s\n' % json.dumps({'started': self.indexes[id(job)]}))
+        self.outfile.flush()
+
+def worker_main(infile = sys.stdin, outfile = sys.stdout):
+    """
+    Run jobs from coordinator, see module doc.
+    """
+    args = {}
+    for name, value in json.loads(infile.readline()).iteritems():
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        args[str(name)] = value
+    probe = args.pop('probe', None)
+    if probe != None:
+        args['liveness'] = Liveness(default_liveness_path(), probe['ttl'], probe['port'], \
+                                    probe['timeout'])
+    jobs = []
+    for line in infile:
+        info = json.loads(line)
+        jobs.append(ShellJob(str(info['host']), info['cmd'].encode('utf-8'), str(info['wdir'])))
+    indexes = dict([ (id(job), i) for i, job in enumerate(jobs) ])
+
+    # run_shell_jobs runs list in stack order, give it a copy
+    for job in rsh.run_shell_jobs(list(jobs), monitor = _StartedWriter(outfile, indexes), **args):
+        info = job_to_dict(job)
+        info['done'] = indexes[id(job)]
+        outfile.write('%s\n' % json.dumps(info))
+        outfile.flush()
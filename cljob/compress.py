@@ -0,0 +1,135 @@
+"""
+Compressed return channel for remote cmds output.
+
+Remote cmd stdout and stderr are piped through a small python filter, which
+writes magic and then frames: 1 byte codec, 4 bytes big-endian payload
+length, payload. Codec is chosen for each frame by output size: small
+frames are sent as is ('R'), others are compressed by zlib ('Z') with
+lower level after the first megabytes, so filter doesn't slow down very
+verbose cmds. Frame is sent when 64KB of output is buffered or output
+stalls for a while, so partial output of hanging cmds gets back too.
+
+Decoder on launcher writes decoded output to Capture, so handlers get the
+same output as without compression.
+"""
+
+import struct
+import zlib
+import base64
+
+MAGIC = '\x00CJZ'
+
+FILTER_SOURCE = r'''
+import os, sys, zlib, struct, select
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+fd = sys.stdin.fileno()
+total = [0]
+def send(data):
+    total[0] += len(data)
+    codec, payload = b'R', data
+    if len(data) >= 256:
+        packed = zlib.compress(data, 6 if total[0] <= 4194304 else 1)
+        if len(packed) < len(data):
+            codec, payload = b'Z', packed
+    out.write(codec + struct.pack('>I', len(payload)) + payload)
+    out.flush()
+out.write(b'\x00CJZ')
+out.flush()
+chunks, size = [], 0
+while True:
+    if select.select([fd], [], [], 0.5)[0]:
+        data = os.read(fd, 65536)
+        if not data:
+            break
+        chunks.append(data)
+        size += len(data)
+        if size < 65536:
+            continue
+    if size > 0:
+        send(b''.join(chunks))
+        chunks, size = [], 0
+if size > 0:
+    send(b''.join(chunks))
+'''
+
+def filter_cmd(python = 'python'):
+    """
+    Return remote shell cmd of compressing filter.
+    """
+    source = base64.b64encode(zlib.compress(FILTER_SOURCE))
+    return '%s -c "import base64,zlib;exec(zlib.decompress(base64.b64decode(\'%s\')))"' % \
+           (python, source)
+
+def wrap_cmd(cmd, python = 'python'):
+    """
+    Return remote shell cmd, running cmd with stdout and stderr compressed
+    by filter_cmd().
+    """
+    compress = filter_cmd(python)
+    # swap stdout and stderr through fd 3 to compress both of them
+    return '{ { %s; } 2>&1 1>&3 3>&- | %s >&2 3>&-; } 3>&1 | %s' % (cmd, compress, compress)
+
+class Decoder(object):
+    """
+    Decode filter output into capture. Stream without magic (for example,
+    rsh error message) is written to capture as is.
+
+    >>> from capture import Capture
+    >>> capture = Capture()
+    >>> decoder = Decoder(capture)
+    >>> packed = zlib.compress('x' * 1000)
+    >>> data = MAGIC + 'R' + struct.pack('>I', 3) + 'abc' + \\
+    ...        'Z' + struct.pack('>I', len(packed)) + packed
+    >>> for i in xrange(0, len(data), 7):
+    ...     decoder.write(data[i:i+7])
+    >>> decoder.flush()
+    >>> capture.getvalue() == 'abc' + 'x' * 1000
+    True
+    >>> capture = Capture()
+    >>> decoder = Decoder(capture)
+    >>> decoder.write('rsh: ')
+    >>> decoder.write('connection refused')
+    >>> capture.getvalue()
+    'rsh: connection refused'
+    """
+    def __init__(self, capture):
+        self.capture = capture
+        self.buffer = ''
+        # None till magic is checked
+        self.framed = None
+
+    def write(self, data):
+        if self.framed == False:
+            self.capture.write(data)
+            return
+
+        self.buffer += data
+        if self.framed == None:
+            if len(self.buffer) < len(MAGIC) and MAGIC.startswith(self.buffer):
+                return
+            if not self.buffer.startswith(MAGIC):
+                self.framed = False
+                self.capture.write(self.buffer)
+                self.buffer = ''
+                return
+            self.framed = True
+            self.buffer = self.buffer[len(MAGIC):]
+
+        while len(self.buffer) >= 5:
+            codec, size = struct.unpack('>cI', self.buffer[:5])
+            if len(self.buffer) < size + 5:
+                break
+            payload = self.buffer[5:size+5]
+            self.buffer = self.buffer[size+5:]
+            if codec == 'Z':
+                payload = zlib.decompress(payload)
+            self.capture.write(payload)
+
+    def flush(self):
+        """
+        Write the rest of not framed stream. Incomplete frame of killed
+        filter is dropped.
+        """
+        if self.framed == None:
+            self.capture.write(self.buffer)
+        self.buffer = ''
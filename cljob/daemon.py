@@ -0,0 +1,314 @@
+"""
+Long-running cljob daemon, accepting tool invocations over a Unix socket.
+
+Daemon imports cljob tools (trsh_run, trsh_upload, ...) once and keeps parsed
+host files. Every request is run in a process forked from the daemon, so it
+starts with everything already loaded. Client sends tool name with args and
+gets back stdout, stderr and exit code of the tool.
+
+Frame format: 1 byte type, 4 bytes big-endian payload length, payload.
+Frame types:
+    'r' -- request, json dict with 'argv', 'cwd', 'env' and 'stdin' fields
+    'i' -- stdin data for the tool, empty payload means EOF
+    'o' -- tool stdout data
+    'e' -- tool stderr data
+    'x' -- tool exit code
+"""
+
+import os
+import sys
+import json
+import errno
+import socket
+import struct
+import select
+import imp
+from threading import Thread
+from traceback import print_exc
+
+TOOLS = ['trsh_run', 'trsh_upload', 'trsh_download', 'tcheck_failures']
+
+class DaemonRunning(Exception):
+    pass
+
+def default_socket_path():
+    return os.path.join(os.environ['HOME'], '.cljobd.sock')
+
+def send_frame(sock, frame_type, payload = ''):
+    sock.sendall(struct.pack('>cI', frame_type, len(payload)) + payload)
+
+def _recv_exactly(sock, size):
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if chunk == '':
+            raise EOFError("Connection closed.")
+        data += chunk
+    return data
+
+def recv_frame(sock):
+    frame_type, size = struct.unpack('>cI', _recv_exactly(sock, 5))
+    return frame_type, _recv_exactly(sock, size)
+
+def submit(socket_path, argv, outfile = sys.stdout, errfile = sys.stderr, infile = None):
+    """
+    Run tool in daemon and return its exit code.
+
+    socket_path -- daemon socket
+    argv -- tool name with args, like ['trsh_run', '-t', 'ws1-400', 'uptime']
+    outfile, errfile -- where to write tool stdout and stderr
+    infile -- file to send as tool stdin, None means no stdin
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    send_frame(sock, 'r', json.dumps({
+        'argv': argv,
+        'cwd': os.getcwd(),
+        'env': dict(os.environ),
+        'stdin': infile != None,
+    }))
+
+    if infile != None:
+        def send_stdin():
+            try:
+                for data in iter(lambda: os.read(infile.fileno(), 65536), ''):
+                    send_frame(sock, 'i', data)
+                send_frame(sock, 'i')
+            except socket.error:
+                # tool is done and connection is closed
+                pass
+        sender = Thread(target=send_stdin)
+        sender.daemon = True
+        sender.start()
+
+    outputs = {'o': outfile, 'e': errfile}
+    while True:
+        frame_type, payload = recv_frame(sock)
+        if frame_type == 'x':
+            sock.close()
+            return int(payload)
+        outputs[frame_type].write(payload)
+        outputs[frame_type].flush()
+
+def _run_tool(tool, request, cache_fd):
+    """
+    Run tool main() in current process with std fds already redirected.
+    Never returns.
+    """
+    import opts
+
+    code = 0
+    try:
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        sys.argv = request['argv']
+        tool.main()
+    except SystemExit as ex:
+        if isinstance(ex.code, int):
+            code = ex.code
+        elif ex.code != None:
+            print >> sys.stderr, ex.code
+            code = 1
+    except:
+        print_exc()
+        code = 1
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    # tell the daemon which host files to keep parsed
+    os.write(cache_fd, json.dumps(opts.get_cached_files()))
+    os._exit(code)
+
+def _serve_request(conn, tools, cache_fd):
+    """
+    Handle one client connection in a forked process. Never returns.
+    """
+    code = 1
+    try:
+        try:
+            frame_type, payload = recv_frame(conn)
+        except EOFError:
+            # connection without request: another daemon checks the socket
+            os._exit(0)
+        request = json.loads(payload)
+        argv = [ str(arg) for arg in request['argv'] ]
+        request['argv'] = argv
+        request['cwd'] = str(request['cwd'])
+        request['env'] = dict([ (str(k), str(v)) for k, v in request['env'].iteritems() ])
+
+        name = ''
+        if len(argv) > 0:
+            name = os.path.basename(argv[0])
+        if name not in tools:
+            send_frame(conn, 'e', "Unknown tool '%s', available: %s.\n" % \
+                                  (name, ', '.join(sorted(tools))))
+            send_frame(conn, 'x', '2')
+            os._exit(2)
+
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            conn.close()
+            os.dup2(stdin_r, 0)
+            os.dup2(stdout_w, 1)
+            os.dup2(stderr_w, 2)
+            for fd in [stdin_r, stdin_w, stdout_r, stdout_w, stderr_r, stderr_w]:
+                os.close(fd)
+            try:
+                _run_tool(tools[name], request, cache_fd)
+            finally:
+                os._exit(1)
+
+        os.close(stdin_r)
+        os.close(stdout_w)
+        os.close(stderr_w)
+        os.close(cache_fd)
+
+        if request['stdin']:
+            def relay_stdin():
+                try:
+                    while True:
+                        frame_type, data = recv_frame(conn)
+                        if data == '':
+                            break
+                        os.write(stdin_w, data)
+                except (EOFError, OSError, socket.error):
+                    pass
+                os.close(stdin_w)
+            relay = Thread(target=relay_stdin)
+            relay.daemon = True
+            relay.start()
+        else:
+            os.close(stdin_w)
+
+        outputs = {stdout_r: 'o', stderr_r: 'e'}
+        while len(outputs) > 0:
+            readable, _, _ = select.select(outputs.keys(), [], [])
+            for fd in readable:
+                data = os.read(fd, 65536)
+                if data == '':
+                    os.close(fd)
+                    del outputs[fd]
+                else:
+                    send_frame(conn, outputs[fd], data)
+
+        _, status = os.waitpid(pid, 0)
+        if os.WIFEXITED(status):
+            code = os.WEXITSTATUS(status)
+        send_frame(conn, 'x', str(code))
+    except:
+        print_exc()
+    finally:
+        os._exit(code)
+
+def load_tools(tools_dir, names = TOOLS):
+    """
+    Load cljob tools scripts from tools_dir as modules.
+    """
+    tools = {}
+    for name in names:
+        path = os.path.join(tools_dir, name)
+        if os.path.isfile(path):
+            tools[name] = imp.load_source('cljob_tool_%s' % name, path)
+    return tools
+
+def _remove_stale_socket(socket_path):
+    """
+    Remove socket file left by dead daemon. Raise DaemonRunning if another
+    daemon accepts connections on it.
+    """
+    if not os.path.exists(socket_path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error as ex:
+        if ex.errno not in [errno.ECONNREFUSED, errno.ENOENT]:
+            raise
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        return
+    finally:
+        sock.close()
+    raise DaemonRunning("Another daemon is listening on '%s'." % socket_path)
+
+def serve(socket_path, tools):
+    """
+    Accept requests on socket_path forever.
+
+    Host files parsed by requests are parsed in the daemon too (and checked
+    for updates after each request), so next requests get them from cache.
+
+    socket_path -- Unix socket to listen. Stale socket file is replaced,
+                   DaemonRunning is raised if a daemon is listening on it
+    tools -- dict tool name -> module with main(), see load_tools()
+    """
+    import opts
+
+    _remove_stale_socket(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0077)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    server.listen(128)
+    server.settimeout(1.0)
+
+    children = set()
+    # pipe from child -> cached host files list read so far
+    cache_pipes = {}
+    while True:
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            conn = None
+        except socket.error as ex:
+            if ex.errno != errno.EINTR:
+                raise
+            conn = None
+
+        if conn != None:
+            conn.settimeout(None)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            cache_r, cache_w = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                server.close()
+                os.close(cache_r)
+                for fd in cache_pipes:
+                    os.close(fd)
+                _serve_request(conn, tools, cache_w)
+            os.close(cache_w)
+            conn.close()
+            children.add(pid)
+            cache_pipes[cache_r] = ''
+
+        while len(children) > 0:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            children.discard(pid)
+
+        if len(cache_pipes) == 0:
+            continue
+        readable, _, _ = select.select(cache_pipes.keys(), [], [], 0)
+        for fd in readable:
+            chunk = os.read(fd, 65536)
+            if chunk != '':
+                cache_pipes[fd] += chunk
+                continue
+
+            os.close(fd)
+            data = cache_pipes.pop(fd)
+            if data == '':
+                continue
+            cached_files = []
+            for func_name, file_name, args in json.loads(data):
+                args = tuple([ arg if arg == None else str(arg) for arg in args ])
+                cached_files.append((str(func_name), str(file_name), args))
+            opts.warm_files_cache(cached_files)
@@ -1,6 +1,14 @@
 import sys
+import os
+import json
+import shutil
+from math import log
+from time import time, sleep
+from threading import Thread, Event, RLock
+from Queue import Queue, Empty, Full
 
-from job import job_to_str
+from job import job_to_str, job_to_dict
+from output import job_output
 
 class MergeExceptions(object):
     def __init__(self, outfile = sys.stdout, max_jobs_num = 5, job_to_str_func = job_to_str):
@@ -98,23 +106,14 @@ class MergeOutput(object):
         if job.retcode != 0:
             return
 
-        out = ''
-        job.stdout = job.stdout.strip()
-        job.stderr = job.stderr.strip()
-        if job.stdout != '':
-            out += job.stdout
-        if job.stdout != '' and job.stderr != '':
-            out += '\n%s\n' % ('='*80)
-        if job.stderr != '':
-            out += job.stderr
+        output = job_output(job)
+        if output.digest not in self.outputs:
+            self.outputs[output.digest] = (output, [])
 
-        if out not in self.outputs:
-            self.outputs[out] = []
-
-        self.outputs[out].append(job)
+        self.outputs[output.digest][1].append(job)
 
     def finish(self):
-        for output, jobs in self.outputs.iteritems():
+        for output, jobs in self.outputs.itervalues():
             jobs_info = set([ self.job_to_str_func(job) for job in jobs ])
             if self.max_jobs_num < 0 or len(jobs) <= self.max_jobs_num:
                 jobs_info = ': %s' % ' '.join(sorted(jobs_info))
@@ -124,7 +123,7 @@ class MergeOutput(object):
                 jobs_info = ': %s (and %s jobs more)' % (' '.join(sorted(jobs_info)[:self.max_jobs_num]),
                                                           len(jobs) - self.max_jobs_num)
 
-            print >> self.outfile, 'Output from %s jobs%s\n%s' % (len(jobs), jobs_info, output)
+            print >> self.outfile, 'Output from %s jobs%s\n%s' % (len(jobs), jobs_info, output.text)
             print >> self.outfile
 
 class PrintOutput(object):
@@ -142,18 +141,8 @@ class PrintOutput(object):
         if job.retcode != 0:
             return
 
-        out = ''
-        job.stdout = job.stdout.strip()
-        job.stderr = job.stderr.strip()
-        if job.stdout != '':
-            out += job.stdout
-        if job.stdout != '' and job.stderr != '':
-            out += '\n%s\n' % ('='*80)
-        if job.stderr != '':
-            out += job.stderr
-
         host_info = self.job_to_str_func(job)
-        print >> self.outfile, 'Output from %s:\n%s\n' % (host_info, out)
+        print >> self.outfile, 'Output from %s:\n%s\n' % (host_info, job_output(job).text)
 
 class MergeErrors(object):
     def __init__(self, job_to_str_func = job_to_str, \
@@ -171,19 +160,22 @@ class MergeErrors(object):
         if job.retcode == 0:
             return
 
-        out = '%s:%s' % (job.retcode, job.stderr)
-        if 'stdout' in dir(job) and job.stdout != None and job.stdout != '':
-            out = '%s\n%s' % (out, job.stdout)
+        output = job_output(job)
+        if job.cancelled:
+            out = 'cancelled'
+        elif job.retcode == None:
+            # partial output of timed out jobs differs
+            out = 'timeout'
+        else:
+            out = (job.retcode, output.digest)
 
         if out not in self.outputs:
             self.outputs[out] = {
+                'cancelled': job.cancelled,
                 'retcode': job.retcode,
-                'stderr': job.stderr,
-                'stdout': '',
+                'output': output,
                 'jobs': [],
             }
-            if 'stdout' in dir(job) and job.stdout != None and job.stdout != '':
-                self.outputs['stdout'] = job.stdout
 
         self.outputs[out]['jobs'].append(job)
 
@@ -199,14 +191,18 @@ class MergeErrors(object):
                 jobs_info = ': %s (and %s jobs more)' % (' '.join(sorted(jobs_info)[:self.max_jobs_num]),
                                                           len(jobs) - self.max_jobs_num)
 
-            if info['retcode'] == None:
+            if info['cancelled']:
+                print >> self.outfile, 'Cancelled %s jobs%s' % (len(jobs), jobs_info)
+                print >> self.outfile
+            elif info['retcode'] == None:
                 # job failed by timeout
                 print >> self.outfile, 'Failed by timeout %s jobs: %s' % (len(jobs), jobs_info)
             else:
                 print >> self.outfile, 'Fail with code %s in %s jobs%s' % (info['retcode'], len(jobs), jobs_info)
-                print >> self.outfile, 'Stderr: %s' % info['stderr'].replace('\n', '\n\t')
-                if info['stdout'] != '':
-                    print >> self.outfile, 'Stdout: %s' % info['stdout'].replace('\n', '\n\t')
+                output = info['output']
+                print >> self.outfile, 'Stderr: %s' % output.stderr.replace('\n', '\n\t')
+                if output.stdout != '':
+                    print >> self.outfile, 'Stdout: %s' % output.stdout.replace('\n', '\n\t')
                 print >> self.outfile
 
 class PrintErrors(object):
@@ -224,23 +220,20 @@ class PrintErrors(object):
         if job.retcode == 0:
             return
 
-        out = ''
-        stdout = ''
-        if 'stdout' in dir(job) and job.stdout != None:
-            stdout = job.stdout.strip()
-        job.stderr = job.stderr.strip()
-        if job.stderr != '':
-            out += job.stderr
-        if stdout != '' and stderr != '':
-            out += '\n%s\n' % ('='*80)
-        if stdout != '':
-            out += stdout
-
+        output = job_output(job)
         host_info = self.job_to_str_func(job)
-        print >> self.outfile, 'Fail with code %s in %s job.' % (job.retcode, host_info)
-        print >> self.outfile, 'Stderr: %s' % job.stderr.replace('\n', '\n\t')
-        if job.stdout != '':
-            print >> self.outfile, 'Stdout: %s' % job.stdout.replace('\n', '\n\t')
+        if job.cancelled:
+            print >> self.outfile, 'Cancelled %s job.' % host_info
+            print >> self.outfile
+            return
+        if job.retcode == None:
+            # job failed by timeout
+            print >> self.outfile, 'Failed by timeout %s job.' % host_info
+        else:
+            print >> self.outfile, 'Fail with code %s in %s job.' % (job.retcode, host_info)
+        print >> self.outfile, 'Stderr: %s' % output.stderr.replace('\n', '\n\t')
+        if output.stdout != '':
+            print >> self.outfile, 'Stdout: %s' % output.stdout.replace('\n', '\n\t')
         print >> self.outfile
 
 def exception_hash(err, traceback = None):
@@ -306,6 +299,8 @@ class JobStatuses(object):
         return self.stat
 
 class ProgressBar(object):
+    order_insensitive = True
+
     def __init__(self, pbar):
         self.pbar = pbar
         self.pbar.start()
@@ -319,7 +314,224 @@ class ProgressBar(object):
         self.pbar.finish()
         print
 
+class DurationHistogram(object):
+    """
+    Histogram of durations with logarithmic buckets: constant memory and
+    time for any number of values, quantiles within 5% precision.
+
+    >>> hist = DurationHistogram()
+    >>> for duration in [0.1] * 98 + [10.0, 20.0]:
+    ...     hist.add(duration)
+    >>> '%.2f %.0f' % (hist.quantile(0.5), hist.quantile(0.99))
+    '0.10 10'
+    """
+    BASE = 1.05
+    MIN_DURATION = 0.001
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+
+    def add(self, duration):
+        bucket = 0
+        if duration > self.MIN_DURATION:
+            bucket = int(log(duration / self.MIN_DURATION, self.BASE) + 0.5)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return self.MIN_DURATION * self.BASE ** bucket
+        return None
+
+def format_duration(seconds):
+    """
+    >>> format_duration(0.0123), format_duration(75), format_duration(7300)
+    ('12ms', '1m15s', '2h01m')
+    """
+    if seconds < 1:
+        return '%dms' % (seconds * 1000)
+    if seconds < 60:
+        return '%.1fs' % seconds
+    if seconds < 3600:
+        return '%dm%02ds' % (seconds / 60, seconds % 60)
+    return '%dh%02dm' % (seconds / 3600, seconds % 3600 / 60)
+
+class StatusLine(object):
+    """
+    Status line on a terminal, shared with other output: files returned by
+    wrap() clear the status line before writing, and it is redrawn only
+    when all of them are at the start of a line.
+    """
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.lock = RLock()
+        self.shown = False
+        # ids of wrapped files with not finished last line
+        self.partial = set()
+
+    def wrap(self, outfile):
+        return _StatusLineFile(self, outfile)
+
+    def draw(self, status):
+        with self.lock:
+            if len(self.partial) > 0:
+                return
+            self.outfile.write('\r\x1b[K%s\r' % status)
+            self.outfile.flush()
+            self.shown = True
+
+    def clear(self):
+        with self.lock:
+            if self.shown:
+                self.outfile.write('\r\x1b[K')
+                self.outfile.flush()
+                self.shown = False
+
+class _StatusLineFile(object):
+    def __init__(self, line, outfile):
+        self.line = line
+        self.outfile = outfile
+        self.softspace = 0
+
+    def write(self, data):
+        if data == '':
+            return
+        with self.line.lock:
+            self.line.clear()
+            self.outfile.write(data)
+            # other stream could be buffered, show data before status is redrawn
+            self.outfile.flush()
+            if data.endswith('\n'):
+                self.line.partial.discard(id(self))
+            else:
+                self.line.partial.add(id(self))
+
+    def flush(self):
+        self.outfile.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.outfile, name)
+
+def shared_output(handlers, outfile):
+    """
+    Return file for a handler, writing outfile while jobs are running: if
+    handlers have a Dashboard, its status line is cleared before writes.
+    """
+    for hnd in handlers:
+        if isinstance(hnd, Dashboard):
+            return hnd.wrap(outfile)
+    return outfile
+
+class Dashboard(object):
+    """
+    Live status line: done jobs, jobs/sec, running jobs, p50/p99 job
+    duration, failure rate and ETA.
+
+    Status is redrawn by a timer thread a few times a second, so its cost
+    doesn't depend on how fast jobs are done. Status line is written to
+    outfile only if it is a terminal; the final status is always written.
+    Other handlers writing to a terminal while jobs run must use files from
+    wrap() (see shared_output), to not mix their lines with status line.
+    Needs job_started() calls from runner to count running jobs (see
+    Dispatcher).
+    """
+    order_insensitive = True
+
+    def __init__(self, total = None, outfile = sys.stderr, interval = 0.25):
+        """
+        total -- number of jobs, None if unknown (streaming)
+        outfile -- where to write
+        interval -- seconds between redraws
+        """
+        self.total = total
+        self.outfile = outfile
+        self.started = 0
+        self.done = 0
+        self.failed = 0
+        self.durations = DurationHistogram()
+        self.start_time = time()
+        self.predicted = None
+
+        self.stop = Event()
+        self.is_tty = hasattr(outfile, 'isatty') and outfile.isatty()
+        if self.is_tty:
+            self.line = StatusLine(outfile)
+            self.outfile = self.line.wrap(outfile)
+            self.timer = Thread(target=self._redraw, args=(interval,))
+            self.timer.daemon = True
+            self.timer.start()
+
+    def wrap(self, outfile):
+        """
+        Return file to write outfile without breaking status line.
+        """
+        if not self.is_tty or not hasattr(outfile, 'isatty') or not outfile.isatty():
+            return outfile
+        return self.line.wrap(outfile)
+
+    def makespan_predicted(self, seconds):
+        self.predicted = seconds
+        print >> self.outfile, 'Predicted time %s' % format_duration(seconds)
+
+    def hosts_unprobed(self, num):
+        print >> self.outfile, '%s hosts are not probed, their names are not resolved in time' % num
+
+    def job_started(self, job):
+        # coalesced jobs are done as several jobs
+        self.started += len(getattr(job, 'jobs', [job]))
+
+    def __call__(self, job):
+        self.done += 1
+        if job.exception != None or job.retcode != 0:
+            self.failed += 1
+        if job.exception == None and job.start_time != None and job.end_time != None:
+            self.durations.add(job.end_time - job.start_time)
+
+    def status(self):
+        elapsed = max(time() - self.start_time, 0.001)
+        rate = self.done / elapsed
+        done = '%s' % self.done
+        if self.total != None:
+            done = '%s/%s' % (self.done, self.total)
+        status = '%s done, %.1f jobs/s, %s running' % (done, rate, max(self.started - self.done, 0))
+
+        if self.durations.count > 0:
+            status += ', p50 %s, p99 %s' % (format_duration(self.durations.quantile(0.5)), \
+                                            format_duration(self.durations.quantile(0.99)))
+        if self.done > 0:
+            status += ', %.1f%% failed' % (100.0 * self.failed / self.done)
+
+        if self.total != None and self.done < self.total and rate > 0:
+            status += ', ETA %s' % format_duration((self.total - self.done) / rate)
+        else:
+            status += ', elapsed %s' % format_duration(elapsed)
+        if self.predicted != None:
+            status += ' (predicted %s)' % format_duration(self.predicted)
+        return status
+
+    def _redraw(self, interval):
+        while not self.stop.is_set():
+            self.line.draw(self.status())
+            self.stop.wait(interval)
+
+    def finish(self):
+        self.stop.set()
+        if self.is_tty:
+            self.timer.join()
+            self.line.clear()
+        print >> self.outfile, self.status()
+        print >> self.outfile
+
 class DoneJobsToFile(object):
+    order_insensitive = True
+
     def __init__(self, fname, job_formatter_func):
         self.job_formatter_func = job_formatter_func
         self.outfile = open(fname, 'w')
@@ -331,6 +543,8 @@ class DoneJobsToFile(object):
         print >> self.outfile, self.job_formatter_func(job)
 
 class FailedJobsAppendFile(object):
+    order_insensitive = True
+
     def __init__(self, fname, job_formatter_func):
         self.job_formatter_func = job_formatter_func
         self.outfile = open(fname, 'a')
@@ -341,3 +555,203 @@ class FailedJobsAppendFile(object):
 
         print >> self.outfile, self.job_formatter_func(job)
 
+
+class JsonLines(object):
+    """
+    Write one compact json record for each done job (see job.job_to_dict),
+    as soon as job is done. Nothing is kept in memory.
+    """
+    order_insensitive = True
+
+    def __init__(self, outfile, with_output = True):
+        """
+        outfile -- file name or '-' for stdout
+        with_output -- write jobs stdout and stderr, otherwise only hashes
+        """
+        self.outfile = sys.stdout
+        if outfile != '-':
+            self.outfile = open(outfile, 'w')
+        self.with_output = with_output
+
+    def handle_batch(self, jobs):
+        self.outfile.write(''.join([ '%s\n' % json.dumps(job_to_dict(job, self.with_output), \
+                                                          separators=(',', ':')) \
+                                     for job in jobs ]))
+        self.outfile.flush()
+
+    def __call__(self, job):
+        self.handle_batch([job])
+
+    def finish(self):
+        if self.outfile is not sys.stdout:
+            self.outfile.close()
+
+class UpdateSnapshotLink(object):
+    """
+    Point 'latest' symlink in the parent dir of successful download job target
+    to the target dir (snapshot) and remove old snapshots.
+    """
+    def __init__(self, link_name = 'latest', keep_snapshots = 0):
+        """
+        link_name -- name of symlink to the last snapshot
+        keep_snapshots -- number of snapshots to keep. Zero means keep all
+        """
+        self.link_name = link_name
+        self.keep_snapshots = keep_snapshots
+
+    def __call__(self, job):
+        if job.exception != None or job.retcode != 0:
+            return
+
+        snapshots_dir, snapshot = os.path.split(os.path.normpath(job.target))
+        link = os.path.join(snapshots_dir, self.link_name)
+        tmp_link = '%s.%s' % (link, os.getpid())
+        os.symlink(snapshot, tmp_link)
+        os.rename(tmp_link, link)
+
+        if self.keep_snapshots <= 0:
+            return
+
+        snapshots = sorted([ name for name in os.listdir(snapshots_dir) \
+                             if name != self.link_name and \
+                                os.path.isdir(os.path.join(snapshots_dir, name)) and \
+                                not os.path.islink(os.path.join(snapshots_dir, name)) ])
+        for name in snapshots[:-self.keep_snapshots]:
+            shutil.rmtree(os.path.join(snapshots_dir, name))
+
+_STOP = object()
+
+class Dispatcher(object):
+    """
+    Run handlers in consumer threads, fed by bounded queues, so slow handlers
+    don't stop the jobs runner from checking and starting jobs.
+
+    By default handlers are called in one thread one after another for each
+    job, in jobs completion order. Handler could declare:
+        order_insensitive = True -- it doesn't need to see jobs in the same
+            order as other handlers, so it runs in a separate thread.
+        thread_safe = True -- it could be called from several threads at
+            once, so it runs in several threads (order is not kept too).
+    Jobs are delivered in batches: handler with handle_batch(jobs) method gets
+    the whole batch, other handlers are called for each job.
+    """
+    def __init__(self, handlers, queue_size = 1000, batch_size = 100, workers = 4):
+        """
+        handlers -- list of handlers
+        queue_size -- maximum number of jobs waiting for each consumer thread.
+                      When it is reached, runner waits for handlers
+        batch_size -- maximum number of jobs delivered to handlers at once
+        workers -- number of threads for thread safe handlers
+        """
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.errors = []
+
+        ordered = []
+        stages = []
+        for hnd in handlers:
+            if getattr(hnd, 'thread_safe', False):
+                stages.append(([hnd], workers))
+            elif getattr(hnd, 'order_insensitive', False):
+                stages.append(([hnd], 1))
+            else:
+                ordered.append(hnd)
+        if len(ordered) > 0:
+            stages.append((ordered, 1))
+
+        self.stages = []
+        for stage_handlers, threads_num in stages:
+            queue = Queue(queue_size)
+            threads = []
+            for _ in xrange(threads_num):
+                thread = Thread(target=self._consume, args=(queue, stage_handlers))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            self.stages.append((queue, threads))
+
+    def _consume(self, queue, handlers):
+        while True:
+            batch = [queue.get()]
+            while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                try:
+                    batch.append(queue.get_nowait())
+                except Empty:
+                    break
+
+            stop = batch[-1] is _STOP
+            if stop:
+                batch.pop()
+
+            if len(self.errors) == 0:
+                try:
+                    for hnd in handlers:
+                        if 'handle_batch' in dir(hnd):
+                            hnd.handle_batch(batch)
+                        else:
+                            for job in batch:
+                                hnd(job)
+                except Exception:
+                    # keep reading queue to not block runner, error is
+                    # raised in finish()
+                    self.errors.append(sys.exc_info())
+
+            if stop:
+                return
+
+    def job_started(self, job):
+        """
+        Pass job start to handlers with job_started() method. It is called
+        from runner directly, so it must be fast and thread safe.
+        """
+        for hnd in self.handlers:
+            if 'job_started' in dir(hnd):
+                hnd.job_started(job)
+
+    def makespan_predicted(self, seconds):
+        """
+        Pass predicted time of all jobs to handlers with makespan_predicted()
+        method, before jobs are started.
+        """
+        for hnd in self.handlers:
+            if 'makespan_predicted' in dir(hnd):
+                hnd.makespan_predicted(seconds)
+
+    def hosts_unprobed(self, num):
+        """
+        Pass number of hosts, which are not probed before start, to handlers
+        with hosts_unprobed() method.
+        """
+        for hnd in self.handlers:
+            if 'hosts_unprobed' in dir(hnd):
+                hnd.hosts_unprobed(num)
+
+    def __call__(self, job):
+        for queue, _ in self.stages:
+            while True:
+                try:
+                    # put with timeout could be interrupted by KeyboardInterrupt
+                    queue.put(job, True, 1.0)
+                    break
+                except Full:
+                    continue
+
+    def finish(self):
+        """
+        Wait for all jobs to be handled and finish handlers.
+        """
+        for queue, threads in self.stages:
+            for _ in threads:
+                queue.put(_STOP)
+        for _, threads in self.stages:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(1.0)
+
+        if len(self.errors) > 0:
+            error = self.errors[0]
+            raise error[0], error[1], error[2]
+
+        for hnd in self.handlers:
+            if 'finish' in dir(hnd):
+                hnd.finish()
@@ -0,0 +1,161 @@
+"""
+History of job durations, used to start the longest jobs first.
+
+Durations are kept as exponentially weighted moving averages for each
+host:path with cmd and for each cmd on all hosts, so a new host running a
+known cmd gets a reasonable estimate too. History is a json file, updated
+after each run.
+"""
+
+import os
+import json
+import heapq
+from time import time
+
+from job import job_path
+
+def default_history_path():
+    return os.path.join(os.environ['HOME'], '.cljob_history')
+
+def job_kind(job):
+    """
+    Cmd of shell job or class name for other jobs.
+    """
+    if 'cmd' in dir(job):
+        return job.cmd
+    return job.__class__.__name__
+
+def predict_makespan(durations, slots):
+    """
+    Predict time of running jobs with durations in slots simultaneous jobs,
+    longest first.
+
+    >>> predict_makespan([5, 1, 1, 1, 1, 1], 2)
+    5
+    >>> predict_makespan([3, 3, 2, 2, 2], 2)
+    7
+    """
+    finish_times = [0] * min(slots, len(durations))
+    for duration in sorted(durations, reverse=True):
+        heapq.heapreplace(finish_times, finish_times[0] + duration)
+    return max(finish_times + [0])
+
+class History(object):
+    """
+    >>> history = History(os.devnull)
+    >>> from job import ShellJob
+    >>> jobs = [ ShellJob(host, 'make') for host in ['ws1', 'ws2', 'ws3'] ]
+    >>> for job, duration in zip(jobs, [60, 5, 10]):
+    ...     job.retcode, job.start_time, job.end_time = 0, 0, duration
+    ...     history.record(job)
+    >>> history.schedule(jobs[::-1])[-1].host
+    'ws1'
+    >>> '%.2f' % history.expected(ShellJob('ws4', 'make'))
+    '33.45'
+    >>> jobs[0].cancelled, jobs[0].end_time = True, 1
+    >>> history.record(jobs[0])
+    >>> history.expected(jobs[0])
+    60
+    """
+    def __init__(self, path, alpha = 0.3, max_entries = 100000):
+        """
+        path -- history file
+        alpha -- weight of the last duration in the moving average
+        max_entries -- history size, least recently updated entries are dropped
+        """
+        self.path = path
+        self.alpha = alpha
+        self.max_entries = max_entries
+        # key -> [duration, update time]
+        self.durations = self._load()
+        self.updated = {}
+
+    def _load(self):
+        try:
+            return json.load(open(self.path))
+        except (IOError, ValueError):
+            return {}
+
+    def _keys(self, job):
+        kind = job_kind(job)
+        return '%s\t%s' % (job_path(job), kind), '*\t%s' % kind
+
+    def expected(self, job):
+        """
+        Return expected job duration or None if job was never run.
+        """
+        for key in self._keys(job):
+            if key in self.durations:
+                return self.durations[key][0]
+        return None
+
+    def record(self, job):
+        if job.exception != None or job.start_time == None or job.end_time == None:
+            return
+        if job.cancelled:
+            # terminated by aborted rollout, duration says nothing
+            return
+        duration = job.end_time - job.start_time
+        for key in self._keys(job):
+            old = self.durations.get(key)
+            if old == None:
+                new = duration
+            elif job.timeouted:
+                # real duration is unknown, but not less than this
+                new = max(old[0], duration)
+            else:
+                new = old[0] + self.alpha * (duration - old[0])
+            self.durations[key] = self.updated[key] = [new, time()]
+
+    def _expected_all(self, jobs):
+        """
+        Return expected durations of jobs, jobs without history are expected
+        to take average time. Return None if there is no history for all jobs.
+        """
+        expected = [ self.expected(job) for job in jobs ]
+        known = [ duration for duration in expected if duration != None ]
+        if len(known) == 0:
+            return None
+        default = sum(known) / len(known)
+        return [ default if duration == None else duration for duration in expected ]
+
+    def schedule(self, jobs):
+        """
+        Sort jobs list for stack order runner: jobs with the longest expected
+        duration go last, so they are started first. Return jobs.
+        """
+        expected = self._expected_all(jobs)
+        if expected != None:
+            order = dict(zip([ id(job) for job in jobs ], expected))
+            jobs.sort(key = lambda job: order[id(job)])
+        return jobs
+
+    def predict(self, jobs, slots):
+        """
+        Return predicted time of running jobs or None if there is no
+        history for them.
+        """
+        expected = self._expected_all(jobs)
+        if expected == None:
+            return None
+        return predict_makespan(expected, slots)
+
+    def save(self):
+        """
+        Merge recorded durations into history file.
+        """
+        if len(self.updated) == 0:
+            return
+        durations = self._load()
+        durations.update(self.updated)
+        if len(durations) > self.max_entries:
+            keys = sorted(durations, key = lambda key: durations[key][1])
+            for key in keys[:len(durations) - self.max_entries]:
+                del durations[key]
+
+        tmp_path = '%s.%s' % (self.path, os.getpid())
+        tmp_file = open(tmp_path, 'w')
+        json.dump(durations, tmp_file)
+        tmp_file.close()
+        os.rename(tmp_path, self.path)
+        self.updated = {}
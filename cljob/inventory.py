@@ -0,0 +1,194 @@
+"""
+Host groups and ranges.
+
+Range is a host name with numbers in brackets: ws1-[001-400] or
+sdf[150-152,160]. Numbers keep width of the range start, several brackets
+in one name are expanded to all combinations.
+
+Inventory file has named groups of hosts, ranges and other groups:
+
+    # comment
+    [web]
+    ws1-[001-400] ws2-[001-400]
+    [search]
+    sdf[150-152]
+    @web
+
+Group is referenced as @name or just name (then group is used instead of
+host with the same name). Groups are compiled to host lists once and kept in an index file,
+which is rebuilt when inventory file is changed. Each inventory file has its own
+index file.
+"""
+
+import os
+import re
+import marshal
+import hashlib
+
+# host list tokens: brackets could have commas inside
+TOKEN_RE = re.compile(r'(?:[^\s,\[]|\[[^\]]*\])+')
+RANGE_RE = re.compile(r'\[([^\]]*)\]')
+
+def split_hosts(hosts):
+    """
+    Split comma or space separated hosts list, keeping ranges whole.
+
+    >>> split_hosts('ws1-[001-003,005], sdf150 sdf151:/p')
+    ['ws1-[001-003,005]', 'sdf150', 'sdf151:/p']
+    """
+    return TOKEN_RE.findall(hosts)
+
+def _range_values(spec):
+    values = []
+    for part in spec.split(','):
+        bounds = part.split('-')
+        if len(bounds) == 1:
+            values.append(bounds[0])
+            continue
+        if len(bounds) != 2 or not bounds[0].isdigit() or not bounds[1].isdigit():
+            raise Exception("Wrong host range '[%s]'." % spec)
+        width = len(bounds[0])
+        values += [ '%0*d' % (width, i) for i in xrange(int(bounds[0]), int(bounds[1]) + 1) ]
+    return values
+
+def expand_range(name):
+    """
+    Expand host range to list of hosts.
+
+    >>> expand_range('ws1-[008-010]')
+    ['ws1-008', 'ws1-009', 'ws1-010']
+    >>> expand_range('h[1-2]x[a,b]')
+    ['h1xa', 'h1xb', 'h2xa', 'h2xb']
+    >>> expand_range('sdf150')
+    ['sdf150']
+    """
+    match = RANGE_RE.search(name)
+    if match == None:
+        return [name]
+    prefix = name[:match.start()]
+    suffixes = expand_range(name[match.end():])
+    return [ prefix + value + suffix for value in _range_values(match.group(1)) \
+                                     for suffix in suffixes ]
+
+def parse_inventory(file_name):
+    """
+    Read inventory file and return dict of group name -> list of tokens.
+    """
+    groups = {}
+    group = None
+    for line_num, line in enumerate(open(file_name)):
+        line = line.split('#', 1)[0].strip()
+        if line == '':
+            continue
+        if line[0] == '[' and line[-1] == ']':
+            group = line[1:-1].strip()
+            groups.setdefault(group, [])
+            continue
+        if group == None:
+            raise Exception("Hosts out of group on line %s of %s." % (line_num + 1, file_name))
+        groups[group] += split_hosts(line)
+    return groups
+
+def compile_groups(groups):
+    """
+    Expand groups tokens to sorted lists of hosts.
+
+    >>> compiled = compile_groups({'a': ['h[1-2]', '@b'], 'b': ['x', 'h1']})
+    >>> compiled['a'], compiled['b']
+    (['h1', 'h2', 'x'], ['h1', 'x'])
+    """
+    compiled = {}
+    def compile_group(name, stack):
+        if name in compiled:
+            return compiled[name]
+        if name in stack:
+            raise Exception("Cyclic group '%s' in inventory." % name)
+        if name not in groups:
+            raise Exception("Unknown group '%s' in inventory." % name)
+        hosts = set()
+        for token in groups[name]:
+            if token[0] == '@':
+                hosts.update(compile_group(token[1:], stack + [name]))
+            else:
+                hosts.update(expand_range(token))
+        compiled[name] = sorted(hosts)
+        return compiled[name]
+
+    for name in groups:
+        compile_group(name, [])
+    return compiled
+
+def default_inventory_path():
+    return os.path.join(os.environ['HOME'], '.cljob_inventory')
+
+def default_index_path(file_name):
+    """
+    Index path for inventory file: ~/.cljob_inventory.HASH.idx, where HASH
+    is made of the file absolute path.
+
+    >>> default_index_path('/etc/hosts.inv') == default_index_path('/etc/../etc/hosts.inv')
+    True
+    >>> default_index_path('a.inv') == default_index_path('b.inv')
+    False
+    """
+    path_hash = hashlib.md5(os.path.abspath(file_name)).hexdigest()[:12]
+    return os.path.join(os.environ['HOME'], '.cljob_inventory.%s.idx' % path_hash)
+
+class Inventory(object):
+    def __init__(self, file_name, index_path = None):
+        """
+        file_name -- inventory file
+        index_path -- file with compiled groups, default is made by
+                      default_index_path()
+        """
+        self.file_name = os.path.abspath(file_name)
+        self.index_path = index_path or default_index_path(self.file_name)
+        stat = os.stat(self.file_name)
+        self.stamp = (stat.st_mtime, stat.st_size)
+        self.groups = self._load_index()
+        if self.groups == None:
+            self.groups = compile_groups(parse_inventory(self.file_name))
+            self._save_index()
+
+    def _load_index(self):
+        try:
+            index = marshal.load(open(self.index_path, 'rb'))
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if index.get('file') != self.file_name or index.get('stamp') != self.stamp:
+            return None
+        return index['groups']
+
+    def _save_index(self):
+        tmp_path = '%s.%s' % (self.index_path, os.getpid())
+        try:
+            index_file = open(tmp_path, 'wb')
+            marshal.dump({'file': self.file_name, 'stamp': self.stamp, 'groups': self.groups}, \
+                         index_file)
+            index_file.close()
+            os.rename(tmp_path, self.index_path)
+        except (IOError, OSError):
+            # index is only for speed
+            pass
+
+    def expand(self, name):
+        """
+        Expand group, range or host name to list of hosts.
+        """
+        if name[:1] == '@':
+            if name[1:] not in self.groups:
+                raise Exception("Unknown hosts group '%s'." % name[1:])
+            return self.groups[name[1:]]
+        if name in self.groups:
+            return self.groups[name]
+        return expand_range(name)
+
+def expand_hosts(name, inventory = None):
+    """
+    Expand group (if there is inventory), range or host name to list of hosts.
+    """
+    if inventory != None:
+        return inventory.expand(name)
+    if name[:1] == '@':
+        raise Exception("Hosts group '%s' needs inventory." % name[1:])
+    return expand_range(name)
@@ -1,4 +1,5 @@
 import os.path
+import base64
 
 class ShellJob(object):
     def __init__(self, host, cmd, wdir = ''):
@@ -15,6 +16,10 @@ class ShellJob(object):
         self.trace = None
 
         self.timeouted = False
+        # terminated or not started by aborted rollout
+        self.cancelled = False
+        self.start_time = None
+        self.end_time = None
 
     def __str__(self):
         return 'ShellCmd %s:%s %s' % (self.host, self.wdir, self.cmd)
@@ -33,16 +38,22 @@ class UploadJob(object):
         self.trace = None
 
         self.timeouted = False
+        # terminated or not started by aborted rollout
+        self.cancelled = False
+        self.start_time = None
+        self.end_time = None
 
     def __str__(self):
         return 'Upload to %s:%s' % (self.host, self.wdir)
 
 class DownloadJob(object):
-    def __init__(self, host, files, target, base_dir=''):
+    def __init__(self, host, files, target, base_dir='', link_dest=None):
         self.host = host
         self.files = files
         self.target = target
         self.wdir = base_dir
+        # previous snapshot dir: unchanged files are hardlinked from it
+        self.link_dest = link_dest
 
         self.proc = None
         self.retcode = None
@@ -52,10 +63,75 @@ class DownloadJob(object):
         self.trace = None
 
         self.timeouted = False
+        # terminated or not started by aborted rollout
+        self.cancelled = False
+        self.start_time = None
+        self.end_time = None
 
     def __str__(self):
         return 'Download from %s:%s' % (self.host, self.wdir)
 
+class CoalescedJob(object):
+    """
+    Several transfer jobs for one host, run as one session.
+    """
+    def __init__(self, host, jobs):
+        self.host = host
+        self.jobs = jobs
+        self.wdir = ''
+
+        self.proc = None
+        self.retcode = None
+        self.stderr = None
+
+        self.exception = None
+        self.trace = None
+
+        self.timeouted = False
+        # terminated or not started by aborted rollout
+        self.cancelled = False
+        self.start_time = None
+        self.end_time = None
+
+    def __str__(self):
+        return 'Transfer %s paths on %s' % (len(self.jobs), self.host)
+
+class StripeJob(object):
+    """
+    Byte range of a large remote file, downloaded to a local part file.
+    """
+    def __init__(self, job, fname, offset, length, part):
+        """
+        job -- DownloadJob, which file is striped
+        fname -- file name relative to job.wdir
+        offset, length -- byte range of the file
+        part -- local file for the range
+        """
+        self.job = job
+        self.host = job.host
+        self.wdir = job.wdir
+        self.fname = fname
+        self.offset = offset
+        self.length = length
+        self.part = part
+
+        self.proc = None
+        self.retcode = None
+        self.stderr = None
+
+        self.exception = None
+        self.trace = None
+
+        self.timeouted = False
+        # terminated or not started by aborted rollout
+        self.cancelled = False
+        self.start_time = None
+        self.end_time = None
+
+    def __str__(self):
+        return 'Download bytes %s-%s of %s:%s' % (self.offset, self.offset + self.length, \
+                                                 self.host, os.path.join(self.wdir, self.fname))
+
 def job_to_str(job):
     return str(job)
 
@@ -73,3 +149,81 @@ def job_path(job):
         return job.host
     return '%s:%s' % (job.host, job.wdir)
 
+
+def job_to_dict(job, with_output = True):
+    """
+    Job result as a dict of plain values, for json.
+
+    with_output -- add stdout and stderr, otherwise only their hashes (if
+                   output was hashed), sizes and numbers of bytes dropped
+                   by capture limits are added. Hashes and sizes are of the
+                   whole cmd output, the same for rsh and agent runs. Output,
+                   which is not valid utf-8, is base64 encoded and marked by
+                   "stdout_encoding": "base64" (or stderr_encoding), see
+                   dict_output()
+
+    >>> job = ShellJob('ws1-400', 'uptime', 'tmp')
+    >>> job.retcode, job.stdout, job.stderr = 0, 'up 2 days', ''
+    >>> sorted(job_to_dict(job, with_output = False).items())[:4]
+    [('cancelled', False), ('cmd', 'uptime'), ('duration', None), ('end_time', None)]
+    >>> job_to_dict(job)['stdout']
+    u'up 2 days'
+    >>> job.stdout = '\\xff\\xfe'
+    >>> info = job_to_dict(job)
+    >>> info['stdout'], info['stdout_encoding'], 'stderr_encoding' in info
+    ('//4=', 'base64', False)
+    >>> dict_output(info, 'stdout') == job.stdout
+    True
+    """
+    duration = None
+    if job.start_time != None and job.end_time != None:
+        duration = job.end_time - job.start_time
+    exception = None
+    if job.exception != None:
+        exception = '%s.%s: %s' % (job.exception.__class__.__module__, \
+                                   job.exception.__class__.__name__,   \
+                                   str(job.exception).split('\n')[0])
+    info = {
+        'job': job.__class__.__name__,
+        'host': job.host,
+        'path': job.wdir,
+        'retcode': job.retcode,
+        'timeouted': job.timeouted,
+        'cancelled': job.cancelled,
+        'exception': exception,
+        'start_time': job.start_time,
+        'end_time': job.end_time,
+        'duration': duration,
+    }
+    if 'cmd' in dir(job):
+        info['cmd'] = job.cmd
+
+    for stream in ['stdout', 'stderr']:
+        if getattr(job, stream, None) == None:
+            continue
+        if with_output:
+            data = getattr(job, stream)
+            try:
+                info[stream] = data.decode('utf-8')
+            except UnicodeDecodeError:
+                # json needs unicode, keep binary output exactly
+                info[stream] = base64.b64encode(data)
+                info['%s_encoding' % stream] = 'base64'
+        capture = getattr(job, '%s_capture' % stream, None)
+        if capture != None:
+            info['%s_size' % stream] = capture.size
+            info['%s_dropped' % stream] = capture.dropped
+            if capture.hexdigest() != None:
+                info['%s_hash' % stream] = capture.hexdigest()
+    return info
+
+def dict_output(info, stream):
+    """
+    Return output stream ('stdout' or 'stderr') from job_to_dict() result
+    as str, or None if it isn't there.
+    """
+    if info.get(stream) == None:
+        return None
+    if info.get('%s_encoding' % stream) == 'base64':
+        return base64.b64decode(info[stream])
+    return info[stream].encode('utf-8')
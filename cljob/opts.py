@@ -3,14 +3,15 @@ Helper functions for host filters and args in tsky utils.
 """
 
 import re
+import sys
 from optparse import make_option
 import os.path
 from fnmatch import fnmatch
-from progressbar import ProgressBar
 from getpass import getuser
 
 import handler
 import job
+from inventory import Inventory, split_hosts, expand_hosts, default_inventory_path
 
 def resolve_host_path(host_path, default_path):
     """
@@ -52,16 +53,18 @@ def parse_host_paths(hosts, default_path):
     """
     if hosts == None:
         return {}
-    hosts = [x.strip() for x in re.split('[ ,]+', hosts)]
-    hosts = filter(lambda x: len(x) > 0, hosts)
-    hosts = set(hosts)
+    inventory = get_inventory()
     result = {}
-    for host in hosts:
-        host, path = resolve_host_path(host, default_path)
-        if host not in result:
-            result[host] = set()
-
-        result[host].add(path)
+    for token in set(split_hosts(hosts)):
+        name, path = resolve_host_path(token, default_path)
+        # groups could have thousands of hosts
+        get_paths = result.get
+        for host in expand_hosts(name, inventory):
+            paths = get_paths(host)
+            if paths == None:
+                result[host] = set((path,))
+            else:
+                paths.add(path)
     return result
 
 def parse_host_paths_file(file_hnd, default_path):
@@ -84,11 +87,12 @@ def parse_host_paths_file(file_hnd, default_path):
 
     return parse_host_paths(hosts_filter, default_path)
 
-def parse_host_paths_file_cmds(file_hnd, default_path, default_cmd = None):
+def iter_host_paths_cmds(file_hnd, default_path, default_cmd = None):
     """
     Read host paths with commands as a second tab-separated field from file.
 
-    Return dict with host as a key and dict of path->cmd as a value.
+    Yield (host, path, cmd) as soon as each line is read, so file_hnd could be
+    a pipe with lines still being written.
 
     Blank lines and lines started with '#' are skipping
 
@@ -96,17 +100,17 @@ def parse_host_paths_file_cmds(file_hnd, default_path, default_cmd = None):
     default_path -- default path for hosts without :path
     default_cmd -- default command for lines without second field
     """
-    result = {}
     if isinstance(file_hnd, str):
         file_hnd = open(file_hnd, 'r')
 
-    for line in file_hnd:
+    # don't use file iterator: it reads ahead and waits for a full buffer
+    for line in iter(file_hnd.readline, ''):
         line = line.strip()
         if len(line) == 0 or line[0] == '#':
             continue
 
         chunks = line.split('\t')
-        host, path = resolve_host_path(chunks[0], default_path)
+        name, path = resolve_host_path(chunks[0], default_path)
         if len(chunks) == 1:
             if default_cmd == None:
                 raise Exception("Cmd doesn't set for host %s." % line)
@@ -116,6 +120,22 @@ def parse_host_paths_file_cmds(file_hnd, default_path, default_cmd = None):
         else:
             raise Exception("Wrong fields number on line '%s'." % line)
 
+        for host in expand_hosts(name, get_inventory()):
+            yield host, path, cmd
+
+def parse_host_paths_file_cmds(file_hnd, default_path, default_cmd = None):
+    """
+    Read host paths with commands as a second tab-separated field from file.
+
+    Return dict with host as a key and dict of path->cmd as a value.
+    For file format see iter_host_paths_cmds().
+
+    file_hnd -- file name or open file resource for reading
+    default_path -- default path for hosts without :path
+    default_cmd -- default command for lines without second field
+    """
+    result = {}
+    for host, path, cmd in iter_host_paths_cmds(file_hnd, default_path, default_cmd):
         if host not in result:
             result[host] = {}
 
@@ -133,6 +153,18 @@ def parse_host_paths_filter(hosts_filter, default_path):
     hosts_filter -- str like '+SEARCH1 +SDF:/some/path -ws1-400:relative/path'
     default_path -- default path
     """
+    incl_hosts, excl_hosts = split_host_paths_filter(hosts_filter)
+    incl_hosts = parse_host_paths(incl_hosts, default_path)
+    excl_hosts = parse_host_paths(excl_hosts, default_path)
+    return incl_hosts, excl_hosts
+
+def split_host_paths_filter(hosts_filter):
+    """
+    Split hosts filter to included and excluded hosts lists.
+
+    >>> split_host_paths_filter('+SEARCH1 -ws1-[001-003]')
+    ('SEARCH1', 'ws1-[001-003]')
+    """
     chunks = [x.strip() for x in hosts_filter.split(' ')]
     chunks = filter(lambda x: len(x) > 0, chunks)
     chunks = set(chunks)
@@ -146,9 +178,7 @@ def parse_host_paths_filter(hosts_filter, default_path):
         else:
             raise Exception("Can't parse host paths filter '%s' on chunk: '%s'" % (filter, chunk))
 
-    incl_hosts = parse_host_paths(' '.join(incl_hosts), default_path)
-    excl_hosts = parse_host_paths(' '.join(excl_hosts), default_path)
-    return incl_hosts, excl_hosts
+    return ' '.join(incl_hosts), ' '.join(excl_hosts)
 
 def filter_host_paths(incl_hosts, excl_hosts):
     """
@@ -171,23 +201,35 @@ def filter_host_paths(incl_hosts, excl_hosts):
     for host, paths in excl_hosts.iteritems():
         if host not in incl_hosts:
             continue
-        incl_hosts[host] = set(incl_hosts[host]) - set(paths)
-        incl_paths = incl_hosts[host].copy()
-        for incl_path in incl_paths:
-            for excl_path in paths:
-                if excl_path[-1:] == os.path.sep:
-                    excl_path = excl_path[:-1]
-                if fnmatch(incl_path, excl_path):
-                    incl_hosts[host].remove(incl_path)
-                    break
-                if len(excl_path) <= len(incl_path):
-                    if incl_path[:len(excl_path)] == excl_path:
-                        incl_hosts[host].remove(incl_path)
+        incl_hosts[host] = set([ path for path in incl_hosts[host] \
+                                 if not is_path_excluded(path, paths) ])
         if len(incl_hosts[host]) == 0:
             del incl_hosts[host]
 
     return incl_hosts
 
+def is_path_excluded(path, excl_paths):
+    """
+    Check if path matches one of excl_paths.
+
+    Path matches if it is equal to, is under or fnmatch()-es exclude path.
+
+    >>> is_path_excluded('/p1/p2', ['/p3', '/p1/'])
+    True
+    >>> is_path_excluded('/p1/p2', ['/p*/p2'])
+    True
+    >>> is_path_excluded('/p1', ['/p1/p2'])
+    False
+    """
+    for excl_path in excl_paths:
+        if excl_path[-1:] == os.path.sep:
+            excl_path = excl_path[:-1]
+        if fnmatch(path, excl_path):
+            return True
+        if path[:len(excl_path)] == excl_path:
+            return True
+    return False
+
 def implode_host_paths(paths1, paths2):
     """
     Implode two dictionary with host paths
@@ -206,6 +248,9 @@ def implode_host_paths(paths1, paths2):
     >>> sorted(r['h3'])
     ['/some/path']
     """
+    if len(paths1) == 0:
+        return paths2
+
     for host, paths in paths2.iteritems():
         if host not in paths1:
             paths1[host] = paths
@@ -214,6 +259,81 @@ def implode_host_paths(paths1, paths2):
 
     return paths1
 
+_inventory_file = None
+_inventories = {}
+
+def set_inventory_file(file_name):
+    """
+    Use inventory file to expand host groups. None means default inventory
+    ~/.cljob_inventory, if it exists.
+    """
+    global _inventory_file
+    _inventory_file = file_name
+
+def get_inventory():
+    """
+    Return current Inventory or None. Inventory is reloaded if it is changed.
+    """
+    file_name = _inventory_file
+    if file_name == None:
+        file_name = default_inventory_path()
+        if not os.path.exists(file_name):
+            return None
+    stat = os.stat(file_name)
+    inventory = _inventories.get(file_name)
+    if inventory == None or inventory.stamp != (stat.st_mtime, stat.st_size):
+        inventory = _inventories[file_name] = Inventory(file_name)
+    return inventory
+
+def _inventory_stamp():
+    inventory = get_inventory()
+    if inventory == None:
+        return None
+    return (inventory.file_name, inventory.stamp)
+
+_files_cache = {}
+
+def cached_parse(parse_func, file_name, *args):
+    """
+    Return copy of parse_func(file_name, *args) result, parsing file only if
+    it was changed since the last call.
+
+    Long-lived processes (see daemon module) keep parsed host files here.
+    Only for parse functions returning dict of sets or dicts.
+
+    parse_func -- host file parse function from this module
+    file_name -- file name. Open file resources are parsed without cache
+    """
+    if not isinstance(file_name, str):
+        return parse_func(file_name, *args)
+
+    file_name = os.path.abspath(file_name)
+    stat = os.stat(file_name)
+    # host files could have groups from inventory
+    stamp = (stat.st_mtime, stat.st_size, _inventory_stamp())
+    key = (parse_func.__name__, file_name, args)
+    if key not in _files_cache or _files_cache[key][0] != stamp:
+        _files_cache[key] = (stamp, parse_func(file_name, *args))
+
+    return dict([ (host, paths.copy()) for host, paths in _files_cache[key][1].iteritems() ])
+
+def get_cached_files():
+    """
+    Return list of (parse function name, file name, args) from files cache.
+    """
+    return _files_cache.keys()
+
+def warm_files_cache(cached_files):
+    """
+    Parse (or check for updates) files from get_cached_files() list.
+    """
+    for func_name, file_name, args in cached_files:
+        try:
+            cached_parse(globals()[func_name], file_name, *args)
+        except Exception:
+            # file was removed or broken, it will be reported on actual use
+            _files_cache.pop((func_name, file_name, args), None)
+
 def make_host_options():
     """
     Make t:e:T:E:f:u:U: host options for options parser
@@ -222,7 +342,8 @@ def make_host_options():
         make_option('-t', '--hosts', dest='hosts', metavar='HOSTS',   \
                     type='string', action='append', default=[],       \
                     help='list of target hosts (comma or space separated): \
-                          ws1-400, sdf150 sdf151'),
+                          ws1-400, sdf150 sdf151. Hosts could be ranges like \
+                          ws1-[001-400] or @groups from inventory'),
         make_option('-e', '--exclude-hosts', dest='exclude_hosts', metavar='HOSTS',    \
                     type='string', action='append', default=[],       \
                     help='list of hosts to exclude (comma or space separated): \
@@ -236,6 +357,10 @@ def make_host_options():
         make_option('-f', '--hosts-filter', dest='hosts_filter',  \
                     help='hosts filter like "+SEARCH1 -ws1-400"', \
                     metavar='FILTER', type='string', action='append', default=[]),
+        make_option('-I', '--inventory', dest='inventory', metavar='FILE',   \
+                    type='string', default=None,                             \
+                    help='inventory file with hosts groups, default is \
+                          ~/.cljob_inventory (if it exists)'),
     ]
 
 def make_output_options():
@@ -258,7 +383,13 @@ def make_output_options():
         make_option('-q', '--quiet', dest='quiet', action='store_true', \
                     default=False, help="don't output information about errors"),
         make_option('--no-pbar', dest='pbar', action='store_false', default=True, \
-                    help='disable progress bar'),
+                    help='disable progress status line'),
+        make_option('--json-out', dest='json_out', metavar='FILE', type='string', \
+                    help="write json record for each job to FILE ('-' for stdout) \
+                          as soon as job is done"),
+        make_option('--json-no-output', dest='json_output', action='store_false', \
+                    default=True, help="don't write jobs output to --json-out, \
+                                        only its size and hash"),
     ]
 
 def check_options(options):
@@ -301,6 +432,26 @@ def update_host_files(options, ok_hosts, failed_hosts):
             hosts_file.write('\n')
         hosts_file.close()
 
+def parse_exclude_options(options, default_path):
+    """
+    Return dictionary with paths to exclude for host from all filters in
+    options parser.
+
+    options -- options structure, returned by options parser
+    default_path -- default path
+    """
+    set_inventory_file(options.inventory)
+    excl_hosts = parse_host_paths(' '.join(options.exclude_hosts), default_path)
+    for file_name in options.file_exclude_hosts:
+        excl_hosts = implode_host_paths(excl_hosts, cached_parse(parse_host_paths_file, \
+                                                                 file_name, default_path))
+
+    for hosts_filter in options.hosts_filter:
+        _, excl = split_host_paths_filter(hosts_filter)
+        excl_hosts = implode_host_paths(excl_hosts, parse_host_paths(excl, default_path))
+
+    return excl_hosts
+
 def parse_host_options(options, default_path):
     """
     Return dictionary with paths for host from all filters in options parser.
@@ -313,18 +464,17 @@ def parse_host_options(options, default_path):
     if not check_options(options):
         return None
 
+    set_inventory_file(options.inventory)
     incl_hosts = parse_host_paths(' '.join(options.hosts), default_path)
     for file_name in options.file_hosts:
-        incl_hosts = implode_host_paths(incl_hosts, parse_host_paths_file(file_name, default_path))
-
-    excl_hosts = parse_host_paths(' '.join(options.exclude_hosts), default_path)
-    for file_name in options.file_exclude_hosts:
-        excl_hosts = implode_host_paths(excl_hosts, parse_host_paths_file(file_name, default_path))
+        incl_hosts = implode_host_paths(incl_hosts, cached_parse(parse_host_paths_file, \
+                                                                 file_name, default_path))
 
     for hosts_filter in options.hosts_filter:
-        incl, excl = parse_host_paths_filter(hosts_filter, default_path)
-        incl_hosts = implode_host_paths(incl_hosts, incl)
-        excl_hosts = implode_host_paths(excl_hosts, excl)
+        incl, _ = split_host_paths_filter(hosts_filter)
+        incl_hosts = implode_host_paths(incl_hosts, parse_host_paths(incl, default_path))
+
+    excl_hosts = parse_exclude_options(options, default_path)
 
     return filter_host_paths(incl_hosts, excl_hosts)
 
@@ -342,6 +492,7 @@ def parse_host_cmd_options(options, default_path, default_cmd):
     if not check_options(options):
         return None
 
+    set_inventory_file(options.inventory)
     host_cmds = {}
     def add_paths_cmd(host, paths, cmd):
         """
@@ -355,17 +506,11 @@ def parse_host_cmd_options(options, default_path, default_cmd):
             host_cmds[host][path] = cmd
 
 
-    # read exclude host paths from options and files
-    excl_hosts = parse_host_paths(' '.join(options.exclude_hosts), default_path)
-    for file_name in options.file_exclude_hosts:
-        excl_hosts = implode_host_paths(excl_hosts, parse_host_paths_file(file_name, default_path))
-
     # parse host filters
     for hosts_filter in options.hosts_filter:
-        incl, excl = parse_host_paths_filter(hosts_filter, default_path)
-        for host, paths in incl.iteritems():
+        incl, _ = split_host_paths_filter(hosts_filter)
+        for host, paths in parse_host_paths(incl, default_path).iteritems():
             add_paths_cmd(host, paths, default_cmd)
-        excl_hosts = implode_host_paths(excl_hosts, excl)
 
     # and host paths from options with default cmd
     for host, paths in parse_host_paths(' '.join(options.hosts), default_path).iteritems():
@@ -373,9 +518,8 @@ def parse_host_cmd_options(options, default_path, default_cmd):
 
     # add host paths from file
     for fname in options.file_hosts:
-        for host, paths in parse_host_paths_file_cmds(fname,        \
-                                                       default_path, \
-                                                       default_cmd).iteritems():
+        for host, paths in cached_parse(parse_host_paths_file_cmds, fname, \
+                                        default_path, default_cmd).iteritems():
             if host not in host_cmds:
                 host_cmds[host] = paths
             elif len(set(paths.keys()) & set(host_cmds[host].keys())) == 0:
@@ -384,30 +528,52 @@ def parse_host_cmd_options(options, default_path, default_cmd):
             else:
                 raise Exception("Duplicate paths for host '%s'." % host)
 
-    for host, paths in excl_hosts.iteritems():
+    for host, paths in parse_exclude_options(options, default_path).iteritems():
         if host not in host_cmds:
             continue
-        incl_cmds = host_cmds[host].copy()
-        for incl_cmd in incl_cmds:
-            for excl_path in paths:
-                if excl_path[-1:] == os.path.sep:
-                    excl_path = excl_path[:-1]
-                if fnmatch(incl_cmd, excl_path):
-                    del host_cmds[host][incl_cmd]
-                    break
-                if len(excl_path) <= len(incl_cmd):
-                    if incl_cmd[:len(excl_path)] == excl_path:
-                        del host_cmds[host][incl_cmd]
+        for incl_cmd in host_cmds[host].keys():
+            if is_path_excluded(incl_cmd, paths):
+                del host_cmds[host][incl_cmd]
         if len(host_cmds[host]) == 0:
             del host_cmds[host]
 
     return host_cmds
 
+def iter_host_cmd_stream(file_hnd, options, default_path, default_cmd):
+    """
+    Yield (host, path, cmd) from file_hnd as lines arrive, skipping host
+    paths excluded by options.
+
+    For file format see iter_host_paths_cmds(). Duplicate paths are not
+    checked, because it requires to keep all the stream in memory.
+
+    file_hnd -- file name or open file resource for reading
+    options -- options structure, returned by options parser
+    default_path -- default path
+    default_cmd -- default command
+    """
+    excl_hosts = parse_exclude_options(options, default_path)
+    for host, path, cmd in iter_host_paths_cmds(file_hnd, default_path, default_cmd):
+        if host in excl_hosts and is_path_excluded(path, excl_hosts[host]):
+            continue
+        yield host, path, cmd
+
+def text_output(options):
+    """
+    File for human readable output, which goes to stdout unless json
+    records are written there.
+    """
+    if options.json_out == '-':
+        return sys.stderr
+    return sys.stdout
+
 def make_output_handlers(options, jobs):
     handlers = []
-    if not options.quiet and options.merge_err and options.pbar:
-        pbar = ProgressBar(len(jobs))
-        handlers.append(handler.ProgressBar(pbar))
+    if not options.quiet and options.pbar:
+        total = None
+        if isinstance(jobs, list):
+            total = len(jobs)
+        handlers.append(handler.Dashboard(total))
 
     if not options.quiet:
         args = {
@@ -416,10 +582,13 @@ def make_output_handlers(options, jobs):
         }
         if options.merge_err:
             handlers.append(handler.MergeErrors(**args))
-            handlers.append(handler.MergeExceptions(**args))
-        elif not options.quiet:
-            handlers.append(handler.PrintErrors(**args))
-            handlers.append(handler.PrintExceptions(**args))
+            handlers.append(handler.MergeExceptions(outfile = text_output(options), **args))
+        else:
+            # printed while status line is shown
+            handlers.append(handler.PrintErrors(job.job_path, \
+                                                handler.shared_output(handlers, sys.stderr)))
+            handlers.append(handler.PrintExceptions(job.job_path, \
+                                                    handler.shared_output(handlers, text_output(options))))
 
     if options.update_hosts_file != None:
         hnd = handler.DoneJobsToFile(options.update_hosts_file, job.job_path)
@@ -429,6 +598,9 @@ def make_output_handlers(options, jobs):
         hnd = handler.FailedJobsAppendFile(options.append_failed_hosts, job.job_host_path)
         handlers.append(hnd)
 
+    if options.json_out != None:
+        handlers.append(handler.JsonLines(options.json_out, options.json_output))
+
     return handlers
 
 def get_default_dir(default_dir_option = None):
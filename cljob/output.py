@@ -0,0 +1,127 @@
+"""
+Shared read-only view of job output for handlers.
+
+Job output is wrapped once into Output (see job_output()), which keeps the
+original stdout and stderr strings and strip offsets. Stripped streams,
+merged text and digest are computed on the first use and cached, so the
+next handlers get them without touching output bytes again.
+"""
+
+import hashlib
+
+SEPARATOR = '=' * 80
+
+def _strip_span(data):
+    """
+    Return (start, end) of data without leading and trailing whitespace.
+
+    >>> _strip_span(' \\n abc d \\n')
+    (3, 8)
+    >>> _strip_span('  ')
+    (2, 2)
+    """
+    start, end = 0, len(data)
+    while start < end and data[start].isspace():
+        start += 1
+    while end > start and data[end-1].isspace():
+        end -= 1
+    return start, end
+
+class Output(object):
+    """
+    Immutable stdout and stderr of a job, stripped.
+
+    >>> output = Output('\\nok\\n', '')
+    >>> output.stdout, output.stderr, output.text
+    ('ok', '', 'ok')
+    >>> Output('out', 'err').text == 'out\\n%s\\nerr' % SEPARATOR
+    True
+    >>> output.digest == Output('ok', None).digest
+    True
+    >>> output.digest == Output('', 'ok').digest
+    False
+    """
+    __slots__ = ['_streams', '_spans', '_stripped', '_text', '_digest']
+
+    def __init__(self, stdout = None, stderr = None):
+        """
+        stdout, stderr -- str or None, if job has no such stream
+        """
+        self._streams = (stdout, stderr)
+        self._spans = [ _strip_span(data or '') for data in self._streams ]
+        self._stripped = [None, None]
+        self._text = None
+        self._digest = None
+
+    def wraps(self, stdout, stderr):
+        """
+        Check if output is made of these very strings.
+        """
+        return self._streams[0] is stdout and self._streams[1] is stderr
+
+    def _get(self, num):
+        if self._stripped[num] == None:
+            start, end = self._spans[num]
+            # slice of the whole str is the str itself, not a copy
+            self._stripped[num] = (self._streams[num] or '')[start:end]
+        return self._stripped[num]
+
+    @property
+    def stdout(self):
+        return self._get(0)
+
+    @property
+    def stderr(self):
+        return self._get(1)
+
+    def view(self, num):
+        """
+        Return buffer with stripped stdout (num = 0) or stderr (num = 1)
+        without copying it.
+        """
+        start, end = self._spans[num]
+        return buffer(self._streams[num] or '', start, end - start)
+
+    @property
+    def text(self):
+        """
+        Stdout and stderr, separated by a line of '=' if both are not empty.
+        """
+        if self._text == None:
+            if self.stdout != '' and self.stderr != '':
+                self._text = '%s\n%s\n%s' % (self.stdout, SEPARATOR, self.stderr)
+            else:
+                self._text = self.stdout or self.stderr
+        return self._text
+
+    @property
+    def digest(self):
+        """
+        Md5 of stripped stdout and stderr, a key to merge equal outputs.
+        """
+        if self._digest == None:
+            md5 = hashlib.md5()
+            for num in [0, 1]:
+                start, end = self._spans[num]
+                md5.update('%s:' % (end - start))
+                md5.update(self.view(num))
+            self._digest = md5.digest()
+        return self._digest
+
+def job_output(job):
+    """
+    Return Output of job stdout (if job has it) and stderr. Output is made
+    once and kept in job.output, so all handlers share it.
+
+    >>> from job import ShellJob
+    >>> job = ShellJob('ws1-400', 'uptime')
+    >>> job.stdout, job.stderr = 'up 2 days\\n', ''
+    >>> job_output(job) is job_output(job), job_output(job).stdout
+    (True, 'up 2 days')
+    """
+    stdout = getattr(job, 'stdout', None)
+    output = getattr(job, 'output', None)
+    if output == None or not output.wraps(stdout, job.stderr):
+        output = Output(stdout, job.stderr)
+        job.output = output
+    return output
@@ -0,0 +1,196 @@
+"""
+Host liveness probe before starting jobs.
+
+Hosts are checked by non-blocking TCP connect to rsh (ssh) port, all at
+once, so a dead host costs the probe timeout only once and doesn't hold a
+job slot till rsh gives up. Results are kept in a json cache file with
+TTL, so repeated runs over the same hosts don't probe them again.
+"""
+
+import os
+import json
+import errno
+import select
+import socket
+from math import ceil
+from time import time
+from threading import Thread, Event
+from Queue import Queue, Empty
+
+def default_liveness_path():
+    return os.path.join(os.environ['HOME'], '.cljob_liveness')
+
+class HostUnreachable(Exception):
+    pass
+
+def resolve_hosts(hosts, port = 22, timeout = 1.0, threads = 64):
+    """
+    Resolve hosts names in threads, so slow resolver costs the timeout only
+    once for each threads hosts. Return dict host -> (family, type, proto,
+    address) or None if name can't be resolved. Hosts not resolved in
+    timeout seconds for each threads hosts (each thread resolves its hosts
+    one by one) are missed.
+    """
+    queue = Queue()
+    for host in hosts:
+        queue.put(host)
+    result = {}
+    stop = Event()
+
+    def resolve():
+        while not stop.is_set():
+            try:
+                host = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                family, sock_type, proto, _, address = \
+                    socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+                result[host] = (family, sock_type, proto, address)
+            except socket.error:
+                result[host] = None
+
+    workers = []
+    for _ in xrange(min(threads, queue.qsize())):
+        # resolver could hang, don't wait for it at exit
+        worker = Thread(target=resolve)
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    deadline = time() + timeout * ceil(len(hosts) / float(threads))
+    for worker in workers:
+        worker.join(max(deadline - time(), 0))
+    stop.set()
+    return dict(result)
+
+def probe_hosts(hosts, port = 22, timeout = 1.0, max_parallel = 500):
+    """
+    Check hosts by TCP connect to port. Return dict host -> True if host
+    accepts connections, False if it refuses them, doesn't answer in
+    timeout seconds or its name can't be resolved. Hosts, which names are
+    not resolved in time (see resolve_hosts()), are not probed and missed
+    in result.
+
+    >>> probe_hosts(['host.invalid'])
+    {'host.invalid': False}
+    """
+    result = {}
+    addresses = resolve_hosts(hosts, port, timeout)
+    hosts = addresses.keys()
+    poller = select.poll()
+    # fd -> (host, socket, deadline)
+    pending = {}
+    while len(hosts) > 0 or len(pending) > 0:
+        while len(hosts) > 0 and len(pending) < max_parallel:
+            host = hosts.pop()
+            if addresses[host] == None:
+                result[host] = False
+                continue
+            family, sock_type, proto, address = addresses[host]
+            try:
+                sock = socket.socket(family, sock_type, proto)
+            except socket.error:
+                result[host] = False
+                continue
+            sock.setblocking(0)
+            error = sock.connect_ex(address)
+            if error not in [errno.EINPROGRESS, errno.EWOULDBLOCK]:
+                result[host] = error == 0
+                sock.close()
+                continue
+            pending[sock.fileno()] = (host, sock, time() + timeout)
+            poller.register(sock.fileno(), select.POLLOUT)
+
+        if len(pending) == 0:
+            continue
+        wait = min([ deadline for _, _, deadline in pending.itervalues() ]) - time()
+        try:
+            events = poller.poll(max(wait, 0) * 1000)
+        except select.error as ex:
+            if ex[0] != errno.EINTR:
+                raise
+            events = []
+        for fd, _ in events:
+            host, sock, _ = pending.pop(fd)
+            poller.unregister(fd)
+            result[host] = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+            sock.close()
+
+        now = time()
+        for fd, (host, sock, deadline) in pending.items():
+            if deadline <= now:
+                del pending[fd]
+                poller.unregister(fd)
+                result[host] = False
+                sock.close()
+    return result
+
+class Liveness(object):
+    """
+    Cache of hosts probes.
+
+    >>> liveness = Liveness(os.devnull)
+    >>> liveness.hosts['ws1-400'] = [False, time()]
+    >>> liveness.hosts['ws1-401'] = [False, time() - 3600]
+    >>> sorted(liveness.dead_hosts(['ws1-400', 'ws1-401'], probe = False))
+    ['ws1-400']
+    """
+    def __init__(self, path, ttl = 300, port = 22, timeout = 1.0):
+        """
+        path -- cache file
+        ttl -- seconds to trust cached probe result
+        port, timeout -- see probe_hosts()
+        """
+        self.path = path
+        self.ttl = ttl
+        self.port = port
+        self.timeout = timeout
+        # host -> [alive, probe time]
+        self.hosts = self._load()
+        # hosts missed by the last probe
+        self.unprobed = set()
+
+    def _load(self):
+        try:
+            return json.load(open(self.path))
+        except (IOError, ValueError):
+            return {}
+
+    def _fresh(self, host, now):
+        return host in self.hosts and now - self.hosts[host][1] < self.ttl
+
+    def dead_hosts(self, hosts, probe = True):
+        """
+        Return set of unreachable hosts. Hosts without fresh cached result
+        are probed (if probe is True) and saved to cache. Hosts, which are
+        not probed, are not dead, they are set to unprobed.
+        """
+        now = time()
+        unknown = [ host for host in set(hosts) if not self._fresh(host, now) ]
+        if probe and len(unknown) > 0:
+            probed = dict([ (host, [alive, now]) for host, alive in \
+                            probe_hosts(unknown, self.port, self.timeout).iteritems() ])
+            self.hosts.update(probed)
+            self.save(probed)
+            self.unprobed = set(unknown) - set(probed)
+        return set([ host for host in hosts if self._fresh(host, now) and not self.hosts[host][0] ])
+
+    def save(self, probed):
+        """
+        Merge probed hosts into cache file, dropping expired results.
+        """
+        hosts = self._load()
+        hosts.update(probed)
+        now = time()
+        hosts = dict([ (host, info) for host, info in hosts.iteritems() \
+                       if now - info[1] < self.ttl ])
+
+        tmp_path = '%s.%s' % (self.path, os.getpid())
+        try:
+            tmp_file = open(tmp_path, 'w')
+            json.dump(hosts, tmp_file)
+            tmp_file.close()
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            # cache is only for speed
+            pass
@@ -0,0 +1,107 @@
+"""
+Staged rollout of jobs in waves with early abort on failures.
+"""
+
+from math import ceil
+
+class Rollout(object):
+    """
+    Limit started jobs by waves and abort rollout when failures exceed
+    thresholds. Runner asks allowed() before starting jobs and stops when
+    aborted is set; job_started() and job_done() are called for each job.
+
+    >>> rollout = Rollout([1, 10, 100], max_percent = 5)
+    >>> rollout.start(200)
+    >>> rollout.allowed()
+    2
+    >>> for _ in xrange(2):
+    ...     rollout.job_started()
+    >>> rollout.allowed()
+    0
+    >>> class Job(object):
+    ...     exception, retcode, cancelled = None, 0, False
+    >>> for _ in xrange(2):
+    ...     rollout.job_done(Job())
+    >>> rollout.allowed()
+    18
+    >>> failed = Job()
+    >>> failed.retcode = 1
+    >>> for _ in xrange(11):
+    ...     rollout.job_started()
+    ...     rollout.job_done(failed)
+    >>> rollout.aborted
+    True
+    >>> rollout.reason
+    'There is 11 failures, what is more than 5 percents = 10 jobs.'
+    """
+    def __init__(self, waves = [100], max_percent = None, max_failures = None):
+        """
+        waves -- list of percents of all jobs to run by the end of each wave.
+                 Next wave is started when all jobs of the previous one are
+                 done and failures percent is not exceeded
+        max_percent -- maximum percent of failed jobs, of all jobs and of
+                       done jobs at the end of each wave. None means no limit
+        max_failures -- maximum number of failed jobs. None means no limit
+        """
+        self.waves = sorted(waves)
+        if len(self.waves) == 0 or self.waves[-1] < 100:
+            self.waves.append(100)
+        self.max_percent = max_percent
+        self.max_failures = max_failures
+
+        self.limits = [float('inf')]
+        self.wave = 0
+        self.total = None
+        self.started = 0
+        self.done = 0
+        self.failed = 0
+        self.aborted = False
+        self.reason = None
+
+    def start(self, total):
+        """
+        total -- number of jobs, None if unknown: then there is only one wave
+                 and only max_failures threshold is checked
+        """
+        self.total = total
+        if total != None:
+            self.limits = [ int(ceil(total * percent / 100.0)) for percent in self.waves ]
+
+    def abort(self, reason):
+        if self.aborted:
+            # keep the first reason
+            return
+        self.aborted = True
+        self.reason = reason
+
+    def allowed(self):
+        """
+        Return number of jobs, which could be started now.
+        """
+        if self.aborted:
+            return 0
+        while self.wave < len(self.limits) - 1 and self.done >= self.limits[self.wave]:
+            if self.max_percent != None and self.failed * 100.0 > self.done * self.max_percent:
+                self.abort("There is %s failures in %s jobs of wave %s, what is more than %s percents." % \
+                           (self.failed, self.done, self.wave + 1, self.max_percent))
+                return 0
+            self.wave += 1
+        return self.limits[self.wave] - self.started
+
+    def job_started(self):
+        self.started += 1
+
+    def job_done(self, job):
+        if job.cancelled:
+            return
+        self.done += 1
+        if job.exception == None and job.retcode == 0:
+            return
+        self.failed += 1
+
+        if self.max_failures != None and self.failed > self.max_failures:
+            self.abort("There is %s failures, what is more than %s." % (self.failed, self.max_failures))
+        elif self.max_percent != None and self.total != None and \
+             self.failed > self.total * self.max_percent / 100:
+            self.abort("There is %s failures, what is more than %s percents = %s jobs." % \
+                       (self.failed, self.max_percent, self.total * self.max_percent / 100))
@@ -3,12 +3,29 @@
 import os
 import signal
 import re
+import shutil
+import hashlib
+import errno
+import fcntl
+import atexit
+from weakref import WeakSet
+from tempfile import mkdtemp
 from subprocess import Popen, PIPE
 from time import time, sleep
 from sys import exc_info
+from threading import Thread
+from Queue import Queue, Empty
 from traceback import format_tb
 from optparse import make_option
 
+from job import ShellJob, CoalescedJob, StripeJob
+from capture import Capture, CaptureReader, ExitCodeTrailer, TRAILER_CMD
+import agent
+import compress
+from history import History, default_history_path
+from rollout import Rollout
+from probe import Liveness, HostUnreachable, default_liveness_path
+
 def search_path(executable):
     """
     Find rsh on the PATH
@@ -30,6 +47,29 @@ def make_options():
         make_option('--max-simultanious-jobs', dest='max_simultanious_jobs',     \
                     action='store', type='int', default=200, metavar='NUM',        \
                     help='maximum number of simultaious running jobs, zero means no limit'),
+        make_option('--kill-grace', dest='kill_grace', action='store',      \
+                    type='float', default=2.0, metavar='SECONDS',           \
+                    help='time between SIGTERM and SIGKILL for timed out jobs, 2 default'),
+        make_option('--history', dest='history', action='store', type='string', \
+                    default=None, metavar='FILE',                                \
+                    help='file with durations of previous jobs: the longest jobs are \
+                          started first. Default is ~/.cljob_history'),
+        make_option('--no-history', dest='use_history', action='store_false', default=True, \
+                    help='do not use and update jobs durations history'),
+        make_option('--probe', dest='probe', action='store_true', default=False, \
+                    help='check hosts by parallel TCP connect before starting jobs and \
+                          fail jobs of unreachable hosts without running rsh, they are \
+                          reported with merged exceptions, not errors. Results are \
+                          cached in ~/.cljob_liveness'),
+        make_option('--probe-port', dest='probe_port', action='store', type='int', \
+                    default=22, metavar='PORT',                                     \
+                    help='port to probe, 22 default'),
+        make_option('--probe-timeout', dest='probe_timeout', action='store', type='float', \
+                    default=1.0, metavar='SECONDS',                                         \
+                    help='probe connect timeout, 1 second default'),
+        make_option('--probe-ttl', dest='probe_ttl', action='store', type='int', \
+                    default=300, metavar='SECONDS',                                \
+                    help='time to trust cached probe results, 300 seconds default'),
     ]
 
 def parse_options(options):
@@ -38,44 +78,433 @@ def parse_options(options):
         'check_interval': options.check_interval,
         # subprocess.Popen() -> communicate can't handle more than 512 simultanious processes
         'max_simultanious_jobs': min(options.max_simultanious_jobs, 510),
+        'kill_grace': options.kill_grace,
+        'history': parse_history_options(options),
+        'liveness': parse_probe_options(options),
+    }
+
+def make_rollout_options():
+    return [
+        make_option('--waves', dest='waves', action='store', type='string', \
+                    default=None, metavar='PERCENTS',                         \
+                    help='run jobs in waves, for example 1,10,100: 1%% canary, then up \
+                          to 10%% of jobs, then the rest. Next wave starts when the \
+                          previous one is done without exceeding failure thresholds'),
+        make_option('--abort-percent', dest='abort_percent', action='store', type='int', \
+                    default=None, metavar='NUM',                                         \
+                    help='abort rollout: stop starting jobs and cancel running ones, \
+                          when failures exceed NUM percents of all jobs or of done \
+                          jobs at the end of a wave'),
+        make_option('--abort-absolute', dest='abort_absolute', action='store', type='int', \
+                    default=None, metavar='NUM',                                           \
+                    help='abort rollout when there are more than NUM failures'),
+    ]
+
+def parse_rollout_options(options, optparser):
+    if options.waves == None and options.abort_percent == None and options.abort_absolute == None:
+        return {'rollout': None}
+    waves = [100]
+    if options.waves != None:
+        try:
+            waves = [ float(percent) for percent in options.waves.split(',') ]
+        except ValueError:
+            optparser.error("Waves must be comma separated percents, not '%s'." % options.waves)
+        if len([ percent for percent in waves if percent <= 0 or percent > 100 ]) > 0:
+            optparser.error("Waves percents must be greater than 0 and not greater than 100.")
+    return {'rollout': Rollout(waves, options.abort_percent, options.abort_absolute)}
+
+def parse_history_options(options):
+    if not options.use_history:
+        return None
+    return History(options.history or default_history_path())
+
+def parse_probe_options(options):
+    if not options.probe:
+        return None
+    return Liveness(default_liveness_path(), options.probe_ttl, options.probe_port, \
+                    options.probe_timeout)
+
+TAR_COMPRESS_FLAGS = {
+    'none': '',
+    'gzip': 'z',
+    'bzip2': 'j',
+    'xz': 'J',
+}
+
+def make_transfer_options():
+    return [
+        make_option('--engine', dest='engine', action='store',             \
+                    type='choice', choices=['rsync', 'tar'], default='rsync', \
+                    help='transfer engine: rsync (default) or tar. Tar streams all \
+                          files in one pass, what is faster for many small files'),
+        make_option('--tar-compress', dest='tar_compress', action='store',       \
+                    type='choice', choices=sorted(TAR_COMPRESS_FLAGS.keys()),   \
+                    default='gzip', metavar='CODEC',                             \
+                    help='compression for tar engine: none, gzip (default), bzip2 or xz'),
+        make_option('--coalesce', dest='coalesce', action='store_true', default=False, \
+                    help='transfer all paths of one host in one rsync session, only for \
+                          rsync engine'),
+    ]
+
+def parse_transfer_options(options, optparser):
+    if options.engine == 'tar' and options.coalesce:
+        optparser.error("Tar engine can't coalesce transfers, it uses one stream for each job.")
+    return {
+        'engine': options.engine,
+        'tar_compress': options.tar_compress,
+        'coalesce': options.coalesce,
+    }
+
+def make_stripe_options():
+    return [
+        make_option('--stripe-size', dest='stripe_size', action='store', type='int', \
+                    default=0, metavar='BYTES',                                       \
+                    help='download files bigger than BYTES by byte ranges in several \
+                          parallel streams. Zero (default) means never'),
+        make_option('--stripes', dest='stripes', action='store', type='int', \
+                    default=4, metavar='NUM',                                 \
+                    help='number of parallel streams for each striped file, 4 default'),
+    ]
+
+def parse_stripe_options(options, optparser):
+    if options.stripes < 1:
+        optparser.error("Need at least one stripe, not %s." % options.stripes)
+    return {
+        'stripe_size': options.stripe_size,
+        'stripes': options.stripes,
     }
 
-def _run_rsh_jobs(jobs, start_job_func, end_job_func, timeout=10,         \
-                                                      check_interval=0.1, \
-                                                      max_simultanious_jobs = 0):
+# all started processes, to kill process groups left running at exit
+_procs = WeakSet()
+_devnull = None
+
+def _popen(cmd, **args):
+    """
+    Start job process in its own session and process group, so the whole
+    group (with rsync or ssh grandchildren) could be killed. Stdin is
+    /dev/null by default, jobs don't read terminal or tools stdin.
+    """
+    global _devnull
+    if args.get('stdin') == None:
+        if _devnull == None:
+            _devnull = open(os.devnull)
+        args['stdin'] = _devnull
+    proc = Popen(cmd, close_fds = True, preexec_fn = os.setsid, **args)
+    _procs.add(proc)
+    return proc
+
+@atexit.register
+def _kill_procs():
+    for proc in list(_procs):
+        if proc.returncode == None:
+            _kill_group(proc, signal.SIGKILL)
+
+def _kill_group(proc, sig):
+    """
+    Send signal to process group of proc, started by _popen().
+    Return False if there is no such group.
+    """
+    try:
+        os.killpg(proc.pid, sig)
+    except OSError as ex:
+        if ex.errno != errno.ESRCH:
+            raise
+        return False
+    return True
+
+def _job_procs(job):
+    return getattr(job, 'pipeline', None) or [job.proc]
+
+def _read_available(stream):
+    """
+    Read data available in stream without blocking and close it.
+    """
+    fd = stream.fileno()
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    chunks = []
+    while True:
+        try:
+            data = os.read(fd, 65536)
+        except OSError as ex:
+            if ex.errno not in [errno.EAGAIN, errno.EINTR]:
+                raise
+            break
+        if data == '':
+            break
+        chunks.append(data)
+    stream.close()
+    return ''.join(chunks)
+
+def _attach_partial_output(job):
+    """
+    Set job stdout and stderr from output of terminated job.
+    """
+    for writer in getattr(job, 'writers', []):
+        writer.flush()
+    if 'stdout_capture' in dir(job):
+        job.stdout = job.stdout_capture.getvalue().strip()
+        job.stderr = job.stderr_capture.getvalue().strip()
+        return
+    if 'stderr_captures' in dir(job):
+        errors = [ capture.getvalue().strip() for capture in job.stderr_captures ]
+        job.stderr = '\n'.join([ error for error in errors if error != '' ])
+        return
+
+    errors = []
+    for proc in _job_procs(job):
+        if proc.stdout != None and not proc.stdout.closed:
+            _read_available(proc.stdout)
+        if proc.stderr != None and not proc.stderr.closed:
+            stderr = _read_available(proc.stderr).strip()
+            if stderr != '':
+                errors.append(stderr)
+    job.stderr = '\n'.join(errors)
+
+class JobsStack(object):
+    """
+    List of jobs, executed in stack order.
+    """
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def get(self, block = True):
+        if len(self.jobs) == 0:
+            return None
+        return self.jobs.pop()
+
+    def exhausted(self):
+        return len(self.jobs) == 0
+
+class JobsQueue(object):
+    """
+    Jobs from an iterable (for example, generator over stdin lines).
+
+    Iterable is read in a separate thread into a bounded queue, so when all
+    job slots are busy the reader blocks and the producer gets backpressure.
+    """
+    def __init__(self, jobs, maxsize = 0):
+        self.queue = Queue(maxsize)
+        self.is_exhausted = False
+        reader = Thread(target=self._read, args=(jobs,))
+        reader.daemon = True
+        reader.start()
+
+    def _read(self, jobs):
+        try:
+            for job in jobs:
+                self.queue.put((job, None))
+            self.queue.put((None, None))
+        except Exception:
+            self.queue.put((None, exc_info()))
+
+    def get(self, block = True):
+        """
+        Return next job or None if there is no ready jobs.
+        """
+        if self.is_exhausted:
+            return None
+        try:
+            job, error = self.queue.get(block)
+        except Empty:
+            return None
+
+        if job == None:
+            self.is_exhausted = True
+            if error != None:
+                raise error[0], error[1], error[2]
+        return job
+
+    def exhausted(self):
+        return self.is_exhausted
+
+def _run_rsh_jobs(jobs, start_job_func, end_job_func, history = None, liveness = None, **args):
+    """
+    Run jobs and yield them as they are done, see _run_jobs() for args.
+
+    history -- History of jobs durations. List of jobs is reordered to start
+               the longest jobs first, predicted time is passed to monitor
+               makespan_predicted(seconds) method. Durations of done jobs
+               are saved to history
+    liveness -- probe.Liveness: hosts of jobs list are probed before start,
+                jobs of dead hosts fail with HostUnreachable without
+                starting processes. Number of hosts, which are not probed
+                in time, is passed to monitor hosts_unprobed(num) method.
+                Other iterables are checked only by cached results
+    """
+    monitor = args.get('monitor')
+    rollout = args.get('rollout')
+    if liveness != None:
+        if isinstance(jobs, list):
+            dead_hosts = liveness.dead_hosts([ job.host for job in jobs ])
+            if len(liveness.unprobed) > 0 and monitor != None and 'hosts_unprobed' in dir(monitor):
+                monitor.hosts_unprobed(len(liveness.unprobed))
+        else:
+            dead_hosts = None
+        start_job_func = _probed_start_func(start_job_func, liveness, dead_hosts)
+    if history != None and isinstance(jobs, list) and len(jobs) > 0:
+        history.schedule(jobs)
+        slots = args.get('max_simultanious_jobs', 0) or len(jobs)
+        predicted = history.predict(jobs, slots)
+        if predicted != None and monitor != None and 'makespan_predicted' in dir(monitor):
+            monitor.makespan_predicted(predicted)
+    try:
+        for job in _run_jobs(jobs, start_job_func, end_job_func, **args):
+            if history != None:
+                history.record(job)
+            if rollout != None:
+                # runner checks rollout state only when it gets control back
+                rollout.job_done(job)
+            yield job
+    finally:
+        if history != None:
+            history.save()
+
+def _probed_start_func(start_job_func, liveness, dead_hosts = None):
+    """
+    Wrap start_job_func to fail jobs of dead hosts.
+
+    dead_hosts -- set of probed dead hosts, None to check cached results
+    """
+    def start_job_func_wrapper(job):
+        if dead_hosts != None:
+            is_dead = job.host in dead_hosts
+        else:
+            is_dead = job.host in liveness.dead_hosts([job.host], probe = False)
+        if is_dead:
+            # same message for all hosts, so failures are merged
+            raise HostUnreachable("Host doesn't accept connections on port %s." % liveness.port)
+        return start_job_func(job)
+    return start_job_func_wrapper
+
+def _run_jobs(jobs, start_job_func, end_job_func, timeout=10,          \
+                                                  check_interval=0.1,  \
+                                                  max_simultanious_jobs = 0, \
+                                                  monitor = None,      \
+                                                  rollout = None,      \
+                                                  kill_grace = 2.0):
+    """
+    Run jobs and yield them as they are done.
+
+    start_job_func could set job.captures to list of (stream, Capture): streams
+    are read into captures while job is running.
+
+    jobs -- list of jobs or any other iterable. List is executed in stack
+            order with timeout for the whole batch. Other iterables are read
+            lazily, only when there are free job slots, and timeout is counted
+            for each job separately.
+    monitor -- object with job_started(job) method, called for each started
+               job (see handler.Dispatcher)
+    rollout -- Rollout, limiting started jobs by waves. When it is aborted,
+               running jobs are terminated and yielded with job.cancelled set,
+               jobs not started yet are yielded cancelled too
+    kill_grace -- seconds between SIGTERM and SIGKILL to process groups of
+                  timed out and cancelled jobs. Terminated jobs are reaped
+                  and get partial output
+    """
     cur_jobs = []
-    jobs_stack = jobs
+    reader = CaptureReader()
+    if isinstance(jobs, list):
+        jobs_stack = JobsStack(jobs)
+        per_job_timeout = False
+        if max_simultanious_jobs == 0:
+            max_simultanious_jobs = len(jobs)
+    else:
+        jobs_stack = JobsQueue(jobs, max_simultanious_jobs)
+        per_job_timeout = True
+        if max_simultanious_jobs == 0:
+            max_simultanious_jobs = float('inf')
+
     if timeout == 0:
         timeout = None
 
-    def run_jobs_from_stack(jobs_cnt):
+    if rollout != None:
+        total = None
+        if isinstance(jobs, list):
+            total = len(jobs)
+        rollout.start(total)
+
+    def run_jobs_from_stack(jobs_cnt, block):
         new_running_jobs = []
         failed_jobs = []
-        while len(new_running_jobs) < jobs_cnt and len(jobs_stack) > 0:
-            job = jobs_stack.pop()
+        if rollout != None:
+            jobs_cnt = min(jobs_cnt, rollout.allowed())
+        while True:
+            used_cnt = len(new_running_jobs)
+            if rollout != None:
+                # failed jobs don't hold slots, but rollout counts them as started
+                used_cnt += len(failed_jobs)
+            if used_cnt >= jobs_cnt:
+                break
+            # wait for the next job only if there is nothing to check
+            job = jobs_stack.get(block and len(new_running_jobs) == 0 \
+                                       and len(failed_jobs) == 0)
+            if job == None:
+                break
+            if rollout != None:
+                rollout.job_started()
             try:
+                job.start_time = time()
                 job.proc = start_job_func(job)
+                for stream, capture in getattr(job, 'captures', []):
+                    reader.add(stream, capture)
                 new_running_jobs.append(job)
+                if monitor != None:
+                    monitor.job_started(job)
             except Exception as ex:
                 job.exception = ex
                 job.trace = ''.join(format_tb(exc_info()[2]))
                 job.proc = None
+                job.end_time = time()
                 failed_jobs.append(job)
         return new_running_jobs, failed_jobs
 
-    def terminate_job(job):
-        try:
-            os.kill(job.proc.pid, signal.SIGTERM)
-        except Exception:
+    def kill_job(job, sig):
+        """
+        Send signal to all process groups of job. Return procs with groups.
+        """
+        procs = []
+        for proc in _job_procs(job):
             try:
-                os.kill(job.proc.pid, signal.SIGKILL)
-            except Exception as ex2:
-                job.exception = ex2
+                if _kill_group(proc, sig):
+                    procs.append(proc)
+            except Exception as ex:
+                job.exception = ex
                 job.trace = ''.join(format_tb(exc_info()[2]))
+        return procs
 
-    if max_simultanious_jobs == 0:
-        max_simultanious_jobs = len(jobs)
-    cur_jobs, failed_jobs = run_jobs_from_stack(max_simultanious_jobs)
+    def terminate_jobs(jobs):
+        """
+        Terminate jobs together: SIGTERM, kill_grace seconds to exit, SIGKILL
+        to whole process groups (orphaned grandchildren too), then reap.
+        """
+        procs = []
+        for job in jobs:
+            if 'cancel' in dir(job.proc):
+                # cmd in remote agent
+                job.proc.cancel()
+            else:
+                procs += kill_job(job, signal.SIGTERM)
+
+        deadline = time() + kill_grace
+        while time() < deadline and len([ proc for proc in procs if proc.poll() == None ]) > 0:
+            # keep reading output, so jobs blocked on full pipes could exit
+            reader.wait(min(check_interval, max(deadline - time(), 0)))
+
+        for job in jobs:
+            if 'cancel' not in dir(job.proc):
+                kill_job(job, signal.SIGKILL)
+        for proc in procs:
+            proc.wait()
+
+        for job in jobs:
+            # keep partial output
+            for stream, _ in getattr(job, 'captures', []):
+                reader.finish(stream, block = False)
+            if 'cancel' not in dir(job.proc):
+                _attach_partial_output(job)
+            job.end_time = time()
+
+    cur_jobs, failed_jobs = run_jobs_from_stack(max_simultanious_jobs, True)
     for job in failed_jobs:
         yield job
 
@@ -83,16 +512,23 @@ def _run_rsh_jobs(jobs, start_job_func, end_job_func, timeout=10,         \
 
     start_time = time()
     while True:
-        if timeout != None and time() - start_time >= timeout:
+        if not per_job_timeout and timeout != None and time() - start_time >= timeout:
             # exit by timeout
             for job in jobs:
                 job.timeouted = True
-                terminate_job(job)
+            terminate_jobs(jobs)
+            for job in jobs:
                 yield job
             break
 
         cur_jobs = []
+        timeouted_jobs = []
         for job in jobs:
+            if per_job_timeout and timeout != None and time() - job.start_time >= timeout:
+                job.timeouted = True
+                timeouted_jobs.append(job)
+                continue
+
             retcode = job.proc.poll()
             if retcode == None:
                 # job doesn't done jet
@@ -100,72 +536,763 @@ def _run_rsh_jobs(jobs, start_job_func, end_job_func, timeout=10,         \
                 continue
 
             job.retcode = retcode
+            job.end_time = time()
+            for stream, _ in getattr(job, 'captures', []):
+                reader.finish(stream)
             end_job_func(job)
             yield job
 
-        new_jobs, failed_jobs = run_jobs_from_stack(max_simultanious_jobs - len(cur_jobs))
+        if len(timeouted_jobs) > 0:
+            terminate_jobs(timeouted_jobs)
+            for job in timeouted_jobs:
+                yield job
+
+        if rollout != None and rollout.aborted:
+            for job in cur_jobs:
+                job.cancelled = True
+            terminate_jobs(cur_jobs)
+            for job in cur_jobs:
+                yield job
+            while True:
+                job = jobs_stack.get(False)
+                if job == None:
+                    break
+                job.cancelled = True
+                yield job
+            break
+
+        new_jobs, failed_jobs = run_jobs_from_stack(max_simultanious_jobs - len(cur_jobs), \
+                                                    len(cur_jobs) == 0)
         cur_jobs += new_jobs
         for job in failed_jobs:
             yield job
         jobs = cur_jobs
-        if len(jobs) == 0:
+        if len(jobs) == 0 and jobs_stack.exhausted():
             # all jobs done
             break
-        sleep(check_interval)
+        if len(jobs) > 0:
+            reader.wait(check_interval)
 
-def run_shell_jobs(jobs, **args):
+def make_capture_options():
+    return [
+        make_option('--capture-head', dest='capture_head', action='store', \
+                    type='int', default=0, metavar='BYTES',                \
+                    help='keep only first BYTES (and --capture-tail last bytes) of each \
+                          job stdout and stderr. Zero for both means keep all output'),
+        make_option('--capture-tail', dest='capture_tail', action='store', \
+                    type='int', default=0, metavar='BYTES',                \
+                    help='keep only last BYTES (and --capture-head first bytes) of each \
+                          job stdout and stderr'),
+        make_option('--capture-hash', dest='capture_hash', action='store', \
+                    type='choice', choices=['md5', 'sha1', 'sha256'],     \
+                    default=None, metavar='ALGO',                          \
+                    help='hash whole stdout and stderr with md5, sha1 or sha256'),
+        make_option('--compress-output', dest='compress_output', action='store_true', \
+                    default=False,                                                \
+                    help='compress cmds stdout and stderr on remote hosts (needs python \
+                          there), what saves bandwidth for verbose cmds'),
+    ]
+
+def parse_capture_options(options):
+    return {
+        'capture_head': options.capture_head,
+        'capture_tail': options.capture_tail,
+        'capture_hash': options.capture_hash,
+        'compress_output': options.compress_output,
+    }
+
+def _shell_job_cmd(job):
+    cmd = job.cmd
+    if job.wdir != '':
+        cmd = 'mkdir -p "%s" && cd "%s" && (%s)' % (job.wdir, job.wdir, cmd)
+    return '(set -o pipefail; set -u; set -e;\n%s\n)' % cmd
+
+class OutputFilterError(Exception):
+    pass
+
+def _set_trailer_exit_code(job, compressed):
+    """
+    Set job.retcode to cmd exit code from job.trailer, if rsh exited
+    normally. Uncompressed output without trailer keeps rsh exit code.
+    Compressed output without trailer means, that remote filter failed (for
+    example, there is no remote python) and cmd exit code is lost, so job
+    gets OutputFilterError with its stderr.
+
+    >>> from capture import Capture
+    >>> job = ShellJob('ws1', 'uptime', '')
+    >>> job.retcode, job.stderr = 0, 'bash: nopython: command not found'
+    >>> job.trailer = ExitCodeTrailer(Capture())
+    >>> job.trailer.write('up 2 days\\n')
+    >>> job.trailer.flush()
+    >>> _set_trailer_exit_code(job, False)
+    >>> job.retcode, job.exception
+    (0, None)
+    >>> _set_trailer_exit_code(job, True)
+    >>> job.retcode, job.exception
+    (None, OutputFilterError('Compressed output has no exit code: bash: nopython: command not found',))
+    >>> job.trailer.write('\\n3\\n')
+    >>> job.trailer.flush()
+    >>> job.retcode, job.exception = 0, None
+    >>> _set_trailer_exit_code(job, True)
+    >>> job.retcode, job.exception
+    (3, None)
+    """
+    if job.retcode != 0:
+        return
+    if job.trailer.retcode != None:
+        job.retcode = job.trailer.retcode
+    elif compressed:
+        job.retcode = None
+        job.exception = OutputFilterError("Compressed output has no exit code: %s" % job.stderr)
+
+def run_shell_jobs(jobs, capture_head = 0, capture_tail = 0, capture_hash = None, \
+                         compress_output = False, use_agent = False, \
+                         remote_python = 'python', **args):
     """
     Run shell cmds on remote hosts.
+
+    Job output is captured by Capture(capture_head, capture_tail, capture_hash)
+    for stdout and stderr, set to job.stdout_capture and job.stderr_capture.
+    job.stdout and job.stderr get captured (probably truncated) output.
+    Captures get only cmd output, exit code trailer of rsh jobs is split by
+    ExitCodeTrailer, so hashes and sizes don't depend on transport.
+
+    compress_output -- compress output on remote hosts, see compress module
+    use_agent -- run cmds in long-lived agents (see agent module), started
+                 once for each host
+    remote_python -- python on remote hosts for agent and output compression
     """
     def start_job_func(job):
-        cmd = job.cmd
-        if job.wdir != '':
-            cmd = 'mkdir -p "%s" && cd "%s" && (%s)' % (job.wdir, job.wdir, cmd)
         # this is an ugly hack to get exit codes from rsh :(
-        cmd = '(set -o pipefail; set -u; set -e;\n%s\n); echo $?' % cmd
-        return Popen(['rsh', job.host, cmd], stdout=PIPE, stderr=PIPE, close_fds = True)
+        cmd = '%s; %s' % (_shell_job_cmd(job), TRAILER_CMD)
+        if compress_output:
+            cmd = compress.wrap_cmd(cmd, remote_python)
+        proc = _popen(['rsh', job.host, cmd], stdout=PIPE, stderr=PIPE)
+        job.stdout_capture = Capture(capture_head, capture_tail, capture_hash)
+        job.stderr_capture = Capture(capture_head, capture_tail, capture_hash)
+        job.trailer = ExitCodeTrailer(job.stdout_capture)
+        # writers are flushed in this order when job is done
+        job.writers = [job.trailer]
+        job.captures = [ (proc.stdout, job.trailer), (proc.stderr, job.stderr_capture) ]
+        if compress_output:
+            decoders = [ compress.Decoder(job.trailer), compress.Decoder(job.stderr_capture) ]
+            job.writers = decoders + job.writers
+            job.captures = [ (proc.stdout, decoders[0]), (proc.stderr, decoders[1]) ]
+        return proc
 
     def end_job_func(job):
-        job.stdout, job.stderr = [ out.strip() for out in job.proc.communicate() ]
-        if job.retcode == 0:
-            # rsh exit normally, get actual cmd exit code from the last line of output
-            last_newline = job.stdout.rfind('\n')
-            if last_newline != -1:
-                job.retcode = int(job.stdout[last_newline+1:])
-                job.stdout = job.stdout[:last_newline]
-            elif re.match('^\d+$', job.stdout) != None:
-                job.retcode = int(job.stdout)
-                job.stdout = ''
-        return
+        for writer in job.writers:
+            writer.flush()
+        job.stdout = job.stdout_capture.getvalue().strip()
+        job.stderr = job.stderr_capture.getvalue().strip()
+        _set_trailer_exit_code(job, compress_output)
+
+    def start_agent_job_func(job):
+        job.stdout_capture = Capture(capture_head, capture_tail, capture_hash)
+        job.stderr_capture = Capture(capture_head, capture_tail, capture_hash)
+        return agent.AgentCall(agent.get_agent(job.host, remote_python), _shell_job_cmd(job), \
+                               capture_head, capture_tail, capture_hash)
+
+    def end_agent_job_func(job):
+        job.proc.write_output(job.stdout_capture, job.stderr_capture)
+        if job.proc.times() != None:
+            # cmd timings on remote host, without agent round trip
+            job.start_time, job.end_time = job.proc.times()
+        job.stdout = job.stdout_capture.getvalue().strip()
+        job.stderr = job.stderr_capture.getvalue().strip()
 
+    if use_agent:
+        start_job_func, end_job_func = start_agent_job_func, end_agent_job_func
     for job in _run_rsh_jobs(jobs, start_job_func, end_job_func, **args):
         yield job
 
-def run_upload_jobs(jobs, **args):
+def _has_nested_paths(paths):
+    """
+    Check if some of paths are equal or one is inside another.
+
+    >>> _has_nested_paths(['/a/b', '/a/bc', 'a/b'])
+    False
+    >>> _has_nested_paths(['/a/b', '/a/b/c'])
+    True
+    """
+    paths = sorted([ os.path.normpath(path) + os.path.sep for path in paths ])
+    for prev, path in zip(paths, paths[1:]):
+        if path.startswith(prev):
+            return True
+    return False
+
+def _coalesce_jobs(jobs, can_coalesce):
+    """
+    Group jobs by host into CoalescedJob-s.
+
+    Hosts with one job and jobs lists rejected by can_coalesce(jobs) are left
+    as is.
+    """
+    host_jobs = {}
+    for job in jobs:
+        host_jobs.setdefault(job.host, []).append(job)
+
+    result = []
+    for host, cur_jobs in host_jobs.iteritems():
+        if len(cur_jobs) > 1 and can_coalesce(cur_jobs):
+            result.append(CoalescedJob(host, cur_jobs))
+        else:
+            result += cur_jobs
+    return result
+
+def _stage_links(stage, links):
+    """
+    Make dir with symlinks stage/path -> target for (path, target) in links.
+    """
+    for path, target in links:
+        link = os.path.join(stage, os.path.normpath(path).lstrip(os.path.sep))
+        if not os.path.isdir(os.path.dirname(link)):
+            os.makedirs(os.path.dirname(link))
+        os.symlink(os.path.abspath(target), link)
+
+def _split_coalesced_job(job):
+    """
+    Copy coalesced job result to its jobs and return them.
+
+    Errors from stderr lines, mentioning one of the jobs paths, are reported
+    only to that job. If there are other error lines (connection errors and
+    so on), all jobs are failed. Jobs get retcode 0 only if the session
+    succeeded or it was a partial transfer with errors of other jobs paths.
+
+    >>> from job import UploadJob
+    >>> job = CoalescedJob('ws1', [ UploadJob('ws1', ['a/'], path) for path in ['/x', '/y'] ])
+    >>> job.timeouted = True
+    >>> [ (sub_job.timeouted, sub_job.retcode) for sub_job in _split_coalesced_job(job) ]
+    [(True, None), (True, None)]
+    >>> job.timeouted, job.retcode, job.stderr = False, 23, 'rsync: mkdir "/x" failed'
+    >>> [ sub_job.retcode for sub_job in _split_coalesced_job(job) ]
+    [23, 0]
+    >>> job.retcode, job.stderr = -9, None
+    >>> [ sub_job.retcode for sub_job in _split_coalesced_job(job) ]
+    [-9, -9]
+    """
+    if 'stage' in dir(job):
+        shutil.rmtree(job.stage, ignore_errors = True)
+
+    jobs_errors = dict([ (sub_job, []) for sub_job in job.jobs ])
+    common_errors = []
+    path_patterns = [ (sub_job, re.compile('(^|["/ ])%s(["/ ]|$)' % \
+                                           re.escape(sub_job.wdir.strip(os.path.sep)))) \
+                      for sub_job in job.jobs ]
+    for line in (job.stderr or '').split('\n'):
+        if line.strip() == '' or re.match('^rsync (error|warning): some files', line):
+            # summary for partial transfer, details are in other lines
+            continue
+        for sub_job, pattern in path_patterns:
+            if pattern.search(line) != None:
+                jobs_errors[sub_job].append(line)
+                break
+        else:
+            common_errors.append(line)
+
+    # session failed only because of some paths, other paths are transferred
+    partial = job.retcode not in [0, None] and not job.timeouted and not job.cancelled and \
+              job.exception == None and len(common_errors) == 0 and \
+              len([ errors for errors in jobs_errors.values() if len(errors) > 0 ]) > 0
+    for sub_job in job.jobs:
+        sub_job.proc = job.proc
+        sub_job.start_time = job.start_time
+        sub_job.end_time = job.end_time
+        sub_job.exception = job.exception
+        sub_job.trace = job.trace
+        sub_job.timeouted = job.timeouted
+        sub_job.cancelled = job.cancelled
+        sub_job.stderr = '\n'.join(common_errors + jobs_errors[sub_job])
+        if partial and len(jobs_errors[sub_job]) == 0:
+            # partial transfer, but nothing is wrong with this path
+            sub_job.retcode = 0
+        else:
+            sub_job.retcode = job.retcode
+    return job.jobs
+
+def _run_coalesced_jobs(jobs, start_job_func, end_job_func, **args):
+    for job in _run_rsh_jobs(jobs, start_job_func, end_job_func, **args):
+        if isinstance(job, CoalescedJob):
+            for sub_job in _split_coalesced_job(job):
+                yield sub_job
+        else:
+            yield job
+
+def _can_coalesce_upload(jobs):
+    """
+    Coalesce only uploads of dirs contents (trsh_upload jobs) to not nested
+    remote paths, either all absolute or all relative to home dir.
+    """
+    wdirs = [ job.wdir for job in jobs ]
+    if '' in wdirs or _has_nested_paths(wdirs):
+        return False
+    if len(set([ os.path.isabs(wdir) for wdir in wdirs ])) != 1:
+        return False
+    for job in jobs:
+        if len(job.files) != 1 or not job.files[0].endswith(os.path.sep):
+            return False
+    return True
+
+def _start_pipeline(job, cmds):
+    """
+    Start cmds with stdout of each one connected to stdin of the next one.
+
+    Set job.pipeline to list of processes. Stdout of the last one is
+    discarded. Stderr of all processes is read while the job is running
+    into job.stderr_captures, so no process blocks on a full pipe.
+    """
+    procs = []
+    stdin = None
+    devnull = open(os.devnull, 'w')
+    try:
+        for num, cmd in enumerate(cmds):
+            stdout = PIPE
+            if num == len(cmds) - 1:
+                stdout = devnull
+            proc = _popen(cmd, stdin=stdin, stdout=stdout, stderr=PIPE)
+            if stdin != None:
+                # so previous process gets SIGPIPE if this one exits
+                stdin.close()
+                procs[-1].stdout = None
+            stdin = proc.stdout
+            procs.append(proc)
+    finally:
+        devnull.close()
+    job.pipeline = procs
+    job.stderr_captures = [ Capture() for proc in procs ]
+    job.captures = [ (proc.stderr, capture) for proc, capture in zip(procs, job.stderr_captures) ]
+
+def _pop_exit_code(stderr):
+    """
+    Split remote cmd exit code, printed to the last line of stderr.
+
+    >>> _pop_exit_code('some error\\n2')
+    ('some error', 2)
+    >>> _pop_exit_code('ssh: connect to host h1 port 22: Connection refused')
+    ('ssh: connect to host h1 port 22: Connection refused', None)
+    """
+    stderr = stderr.strip()
+    last_newline = stderr.rfind('\n')
+    if re.match('^\d+$', stderr[last_newline+1:]) == None:
+        return stderr, None
+    return stderr[:last_newline+1].strip(), int(stderr[last_newline+1:])
+
+def _end_tar_job(job):
+    """
+    Get stderr and exit code of tar pipeline started by _start_pipeline().
+
+    Remote cmd in job.rsh_proc prints exit code by _pop_exit_code() rules.
+    """
+    errors = []
+    job.retcode = None
+    for proc, capture in zip(job.pipeline, job.stderr_captures):
+        retcode = proc.wait()
+        stderr = capture.getvalue()
+        if proc is job.rsh_proc:
+            stderr, remote_retcode = _pop_exit_code(stderr)
+            if retcode == 0:
+                # rsh doesn't return exit code of remote cmd
+                retcode = remote_retcode
+        if stderr.strip() != '':
+            errors.append(stderr.strip())
+        if job.retcode in [None, 0]:
+            job.retcode = retcode
+    job.stderr = '\n'.join(errors)
+
+def _remote_tar_cmd(wdir, tar_cmd, mkdir = False):
+    cmd = tar_cmd
+    if wdir != '':
+        cmd = 'cd \'%s\' && %s' % (wdir, cmd)
+        if mkdir:
+            cmd = 'mkdir -p \'%s\' && %s' % (wdir, cmd)
+    return '(%s); echo $? >&2' % cmd
+
+def run_upload_jobs(jobs, coalesce = False, engine = 'rsync', tar_compress = 'gzip', **args):
+    """
+    Upload files to remote hosts.
+
+    coalesce -- upload all dirs to one host in one rsync session. Remote paths
+                are made from local symlinks: stage/./remote/path/ -> local dir.
+                Tar engine always uses one stream for each job
+    engine -- 'rsync' or 'tar': stream tar archive over rsh in one pass
+    tar_compress -- compression for tar engine, see TAR_COMPRESS_FLAGS
+    """
     def start_job_func(job):
+        if isinstance(job, CoalescedJob):
+            job.stage = mkdtemp(prefix='cljob.')
+            _stage_links(job.stage, [ (sub_job.wdir, sub_job.files[0]) for sub_job in job.jobs ])
+            sources = [ '%s/./%s/' % (job.stage, os.path.normpath(sub_job.wdir).lstrip(os.path.sep)) \
+                        for sub_job in job.jobs ]
+            target = '%s:' % job.host
+            if os.path.isabs(job.jobs[0].wdir):
+                target += '/'
+            return _popen(['rsync', '-qazR'] + sources + [target], stderr=PIPE)
+
         target = '%s:%s' % (job.host, job.wdir)
-        return Popen(['rsync', '-qaz'] + job.files + [target], stderr=PIPE, close_fds = True)
+        return _popen(['rsync', '-qaz'] + job.files + [target], stderr=PIPE)
+
+    def start_tar_job_func(job):
+        flags = TAR_COMPRESS_FLAGS[tar_compress]
+        tar_cmd = [ 'tar', '-c%sf' % flags, '-' ]
+        for fname in job.files:
+            if fname.endswith(os.path.sep):
+                # dir contents, like in rsync
+                # tar resolves relative -C against the previous one
+                tar_cmd += [ '-C', os.path.abspath(fname), '.' ]
+            else:
+                tar_cmd += [ '-C', os.path.abspath(os.path.dirname(fname)), os.path.basename(fname) ]
+        remote_cmd = _remote_tar_cmd(job.wdir, 'tar -x%sf -' % flags, mkdir = True)
+        _start_pipeline(job, [ tar_cmd, [ 'rsh', job.host, remote_cmd ] ])
+        job.rsh_proc = job.pipeline[1]
+        return job.pipeline[-1]
 
     def end_job_func(job):
         _, stderr = job.proc.communicate()
         job.stderr = stderr.strip()
 
-    for job in _run_rsh_jobs(jobs, start_job_func, end_job_func, **args):
+    if engine == 'tar':
+        for job in _run_rsh_jobs(jobs, start_tar_job_func, _end_tar_job, **args):
+            yield job
+        return
+
+    if coalesce:
+        jobs = _coalesce_jobs(jobs, _can_coalesce_upload)
+    for job in _run_coalesced_jobs(jobs, start_job_func, end_job_func, **args):
         yield job
 
-def run_download_jobs(jobs, **args):
+def _can_coalesce_download(jobs):
+    """
+    Coalesce only downloads of relative file names from not nested paths
+    (relative to home dir paths are nested to absolute ones: both are
+    downloaded to stage/path).
+    """
+    wdirs = [ job.wdir.lstrip(os.path.sep) for job in jobs ]
+    if '' in wdirs or _has_nested_paths(wdirs):
+        return False
+    for job in jobs:
+        for fname in job.files:
+            if os.path.isabs(fname):
+                return False
+    return True
+
+class StripeError(Exception):
+    pass
+
+def _split_ranges(size, stripes):
+    """
+    Split size bytes into stripes (offset, length) ranges.
+
+    >>> _split_ranges(10, 3)
+    [(0, 4), (4, 4), (8, 2)]
+    """
+    length = (size + stripes - 1) / stripes
+    return [ (offset, min(length, size - offset)) for offset in xrange(0, size, length) ]
+
+def _quote_files(files):
+    """
+    Quote file names for remote shell.
+
+    >>> print _quote_files(['a b', "it's"])
+    'a b' 'it'\\''s'
+    """
+    return ' '.join([ '\'%s\'' % fname.replace('\'', '\'\\\'\'') for fname in files ])
+
+def _remote_stats_cmd(job):
+    """
+    Remote cmd printing 'SIZE MODE MTIME NAME' lines for regular files of
+    download job, mode is octal.
+    """
+    cmd = 'for f in %s; do if [ -f "$f" ]; then echo "$(stat -c \'%%s %%a %%Y\' "$f") $f"; fi; done' % \
+          _quote_files(job.files)
+    if job.wdir != '':
+        cmd = 'cd \'%s\' && %s' % (job.wdir, cmd)
+    return cmd
+
+def _remote_stats(jobs, **args):
+    """
+    Return dict id(job) -> {fname: (size, mode, mtime)} for regular files of
+    download jobs. Jobs failed to get stats are missed, they are downloaded
+    as usual.
+    """
+    size_jobs = dict([ (id(job), ShellJob(job.host, _remote_stats_cmd(job))) for job in jobs ])
+    # probed dead hosts don't hold slots here too
+    run_args = dict([ (name, args[name]) for name in \
+                      ['timeout', 'check_interval', 'max_simultanious_jobs', 'kill_grace', 'liveness'] \
+                      if name in args ])
+    list(run_shell_jobs(size_jobs.values(), **run_args))
+
+    stats = {}
+    for job in jobs:
+        size_job = size_jobs[id(job)]
+        if size_job.exception != None or size_job.retcode != 0:
+            continue
+        stats[id(job)] = {}
+        for line in size_job.stdout.split('\n'):
+            if line.strip() == '':
+                continue
+            size, mode, mtime, fname = line.strip().split(' ', 3)
+            stats[id(job)][fname] = (int(size), int(mode, 8), int(mtime))
+    return stats
+
+class _StripedDownload(object):
+    """
+    Download job with large files split into StripeJob-s. Other files are
+    downloaded by rest job as usual.
+    """
+    def __init__(self, job, stats, stripe_size, stripes):
+        """
+        stats -- dict of remote file name -> (size, mode, mtime)
+        """
+        self.job = job
+        self.stage = mkdtemp(prefix='.cljob-stripes.', dir=job.target)
+        # fname -> ((size, mode, mtime), list of StripeJob)
+        self.files = {}
+        for num, fname in enumerate(job.files):
+            if fname not in stats or stats[fname][0] < stripe_size:
+                continue
+            size = stats[fname][0]
+            self.files[fname] = (stats[fname], [ StripeJob(job, fname, offset, length,  \
+                                                   os.path.join(self.stage, '%s.%s' % (num, i))) \
+                                         for i, (offset, length) in enumerate(_split_ranges(size, stripes)) ])
+
+        self.rest = None
+        rest_files = [ fname for fname in job.files if fname not in self.files ]
+        if len(rest_files) > 0:
+            self.rest = job.__class__(job.host, rest_files, job.target, base_dir = job.wdir, \
+                                      link_dest = job.link_dest)
+        self.sub_jobs = [ stripe for _, file_stripes in self.files.values() for stripe in file_stripes ]
+        if self.rest != None:
+            self.sub_jobs.append(self.rest)
+        self.pending = len(self.sub_jobs)
+
+    def sub_job_done(self):
+        """
+        Return True when all sub jobs are done.
+        """
+        self.pending -= 1
+        return self.pending == 0
+
+    def finish(self):
+        """
+        Copy sub jobs results to job and join parts of successfully
+        downloaded files.
+        """
+        job = self.job
+        sub_jobs = self.sub_jobs
+        job.proc = sub_jobs[-1].proc
+        job.start_time = min([ sub_job.start_time for sub_job in sub_jobs ])
+        job.end_time = max([ sub_job.end_time for sub_job in sub_jobs ])
+        job.timeouted = True in [ sub_job.timeouted for sub_job in sub_jobs ]
+        job.cancelled = True in [ sub_job.cancelled for sub_job in sub_jobs ]
+        job.stderr = '\n'.join([ sub_job.stderr for sub_job in sub_jobs if sub_job.stderr ])
+        job.retcode = 0
+        for sub_job in sub_jobs:
+            if job.exception == None:
+                job.exception, job.trace = sub_job.exception, sub_job.trace
+            if job.retcode in [0, None]:
+                job.retcode = sub_job.retcode
+
+        try:
+            if job.exception == None and job.retcode == 0 and not job.timeouted:
+                for fname, (stat, file_stripes) in self.files.iteritems():
+                    self._join(fname, stat, [ stripe.part for stripe in file_stripes ])
+        except Exception as ex:
+            job.exception = ex
+            job.trace = ''.join(format_tb(exc_info()[2]))
+        finally:
+            shutil.rmtree(self.stage, ignore_errors = True)
+
+    def _join(self, fname, stat, parts):
+        """
+        Join parts into target file with remote size, mode and mtime.
+        """
+        size, mode, mtime = stat
+        target = os.path.join(self.job.target, os.path.normpath(fname).lstrip(os.path.sep))
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        tmp_path = os.path.join(self.stage, 'joined')
+        tmp_file = open(tmp_path, 'wb')
+        for part in parts:
+            part_file = open(part, 'rb')
+            shutil.copyfileobj(part_file, tmp_file, 1 << 20)
+            part_file.close()
+            os.remove(part)
+        tmp_file.close()
+        if os.path.getsize(tmp_path) != size:
+            raise StripeError("Joined %s has %s bytes instead of %s." % \
+                              (fname, os.path.getsize(tmp_path), size))
+        os.chmod(tmp_path, mode)
+        os.utime(tmp_path, (mtime, mtime))
+        os.rename(tmp_path, target)
+
+class _StripesMonitor(object):
+    """
+    Pass start of striped download job to monitor once for all sub jobs.
+    """
+    def __init__(self, monitor, downloads):
+        self.monitor = monitor
+        self.downloads = downloads
+        self.started = set()
+
+    def job_started(self, job):
+        if id(job) in self.downloads:
+            job = self.downloads[id(job)].job
+            if id(job) in self.started:
+                return
+            self.started.add(id(job))
+        self.monitor.job_started(job)
+
+    def makespan_predicted(self, seconds):
+        if 'makespan_predicted' in dir(self.monitor):
+            self.monitor.makespan_predicted(seconds)
+
+    def hosts_unprobed(self, num):
+        if 'hosts_unprobed' in dir(self.monitor):
+            self.monitor.hosts_unprobed(num)
+
+def _start_stripe_job(job):
+    # md5 of the range goes to stderr, data is teed to stdout through fd 3
+    cmd = '{ tail -c +%s %s | head -c %s | tee /dev/fd/3 | md5sum >&2; } 3>&1' % \
+          (job.offset + 1, _quote_files([job.fname]), job.length)
+    part_file = open(job.part, 'wb')
+    try:
+        return _popen([ 'rsh', job.host, _remote_tar_cmd(job.wdir, cmd) ], \
+                      stdout=part_file, stderr=PIPE)
+    finally:
+        part_file.close()
+
+def _end_stripe_job(job):
+    """
+    Check size and md5 of downloaded part.
+    """
+    _, stderr = job.proc.communicate()
+    stderr, remote_retcode = _pop_exit_code(stderr)
+    if job.retcode == 0:
+        job.retcode = remote_retcode
+    lines = stderr.split('\n')
+    remote_md5 = None
+    if re.match('^[0-9a-f]{32}\s+-$', lines[-1]) != None:
+        remote_md5 = lines.pop().split()[0]
+    job.stderr = '\n'.join(lines).strip()
+    if job.retcode != 0:
+        return
+
+    md5 = hashlib.md5()
+    part_file = open(job.part, 'rb')
+    for data in iter(lambda: part_file.read(1 << 20), ''):
+        md5.update(data)
+    part_file.close()
+    if os.path.getsize(job.part) != job.length or md5.hexdigest() != remote_md5:
+        job.exception = StripeError("%s is corrupted: got %s bytes with md5 %s, expected %s bytes with md5 %s." % \
+                                    (job, os.path.getsize(job.part), md5.hexdigest(), job.length, remote_md5))
+
+def _join_striped_jobs(jobs, downloads):
+    """
+    Yield download jobs instead of their sub jobs, when all of them are done.
+    """
+    for job in jobs:
+        download = downloads.get(id(job))
+        if download == None:
+            yield job
+        elif download.sub_job_done():
+            download.finish()
+            yield download.job
+
+def run_download_jobs(jobs, coalesce = False, engine = 'rsync', tar_compress = 'gzip', \
+                      stripe_size = 0, stripes = 4, **args):
+    """
+    Download files from remote hosts.
+
+    coalesce -- download all paths from one host in one rsync session. Files
+                are downloaded with full remote paths to local stage dir with
+                symlinks stage/remote/path -> local target dir. Tar engine
+                always uses one stream for each job
+    engine -- 'rsync' or 'tar': stream tar archive over rsh in one pass.
+              Tar engine doesn't support link_dest
+    tar_compress -- compression for tar engine, see TAR_COMPRESS_FLAGS
+    stripe_size -- regular files bigger than stripe_size bytes (remote stats
+                   are got by separate rsh jobs first) are downloaded by
+                   byte ranges in stripes parallel jobs. Parts are checked by
+                   md5 and joined, download job is yielded when all its
+                   parts and other files are done. Zero means no striping
+    """
     def start_job_func(job):
+        if isinstance(job, StripeJob):
+            return _start_stripe_job(job)
+        if isinstance(job, CoalescedJob):
+            job.stage = mkdtemp(prefix='cljob.')
+            stage = os.path.join(job.stage, 'target')
+            _stage_links(stage, [ (sub_job.wdir, sub_job.target) for sub_job in job.jobs ])
+            rsync_cmd = [ 'rsync', '-qazRK' ]
+            link_dests = [ (sub_job.wdir, sub_job.link_dest) for sub_job in job.jobs \
+                           if sub_job.link_dest != None ]
+            if len(link_dests) > 0:
+                link_stage = os.path.join(job.stage, 'link_dest')
+                _stage_links(link_stage, link_dests)
+                rsync_cmd += [ '--link-dest=%s' % link_stage ]
+            sources = [ os.path.join(sub_job.wdir, fname) for sub_job in job.jobs \
+                                                          for fname in sub_job.files ]
+            rsync_cmd += [ '%s:%s' % (job.host, sources[0]) ]
+            rsync_cmd += [ ':%s' % fname for fname in sources[1:] ]
+            rsync_cmd += [ stage ]
+            return _popen(rsync_cmd, stderr=PIPE)
+
         rsync_cmd = [ 'rsync', '-qazR' ]
         rsync_cmd += [ '--rsync-path=cd \'%s\' && rsync' % job.wdir ]
+        if job.link_dest != None:
+            rsync_cmd += [ '--link-dest=%s' % os.path.abspath(job.link_dest) ]
         rsync_cmd += [ '%s:' % job.host ]
         rsync_cmd += [ ':%s' % fname for fname in job.files ]
         rsync_cmd += [ job.target ]
-        return Popen(rsync_cmd, stderr=PIPE, close_fds = True)
+        return _popen(rsync_cmd, stderr=PIPE)
+
+    def start_tar_job_func(job):
+        if isinstance(job, StripeJob):
+            return _start_stripe_job(job)
+        if job.link_dest != None:
+            raise Exception("Tar engine doesn't support downloading with link dest.")
+        flags = TAR_COMPRESS_FLAGS[tar_compress]
+        remote_cmd = _remote_tar_cmd(job.wdir, 'tar -c%sf - %s' % (flags, _quote_files(job.files)))
+        tar_cmd = [ 'tar', '-x%sf' % flags, '-', '-C', job.target ]
+        _start_pipeline(job, [ [ 'rsh', job.host, remote_cmd ], tar_cmd ])
+        job.rsh_proc = job.pipeline[0]
+        return job.pipeline[-1]
 
     def end_job_func(job):
+        if isinstance(job, StripeJob):
+            return _end_stripe_job(job)
         _, stderr = job.proc.communicate()
         job.stderr = stderr.strip()
 
-    for job in _run_rsh_jobs(jobs, start_job_func, end_job_func, **args):
-        yield job
+    def end_tar_job_func(job):
+        if isinstance(job, StripeJob):
+            return _end_stripe_job(job)
+        _end_tar_job(job)
+
+    downloads = {}
+    stripe_jobs = []
+    if stripe_size > 0 and len(jobs) > 0:
+        stats = _remote_stats(jobs, **args)
+        run_jobs = []
+        for job in jobs:
+            if len([ size for size, _, _ in stats.get(id(job), {}).values() if size >= stripe_size ]) == 0:
+                run_jobs.append(job)
+                continue
+            download = _StripedDownload(job, stats[id(job)], stripe_size, stripes)
+            for sub_job in download.sub_jobs:
+                downloads[id(sub_job)] = download
+            if download.rest != None:
+                run_jobs.append(download.rest)
+            stripe_jobs += [ sub_job for sub_job in download.sub_jobs if sub_job is not download.rest ]
+        jobs = run_jobs
+        if args.get('monitor') != None:
+            args['monitor'] = _StripesMonitor(args['monitor'], downloads)
 
+    if engine == 'tar':
+        done_jobs = _run_rsh_jobs(jobs + stripe_jobs, start_tar_job_func, end_tar_job_func, **args)
+    else:
+        if coalesce:
+            jobs = _coalesce_jobs(jobs, _can_coalesce_download)
+        done_jobs = _run_coalesced_jobs(jobs + stripe_jobs, start_job_func, end_job_func, **args)
+    for job in _join_striped_jobs(done_jobs, downloads):
+        yield job
@@ -16,7 +16,7 @@ setup(
     license=__license__,
     url=__url__,
     packages=['cljob'],
-    scripts=glob('./trsh*') + ['./tcheck_failures'],
+    scripts=glob('./trsh*') + glob('./tcljob*') + ['./tcheck_failures'],
     classifiers=[
         "Development Status :: 3 - Alpha",
         "Environment :: Console",